@@ -1,22 +1,50 @@
 #!/usr/bin/env python
+import argparse
+import array
+import contextlib
+import csv
+import io
 import time
 import datetime
 import sys
 import os
 import subprocess
-import json
 import signal
 import shlex
+import json
+import mmap
+import struct
+import heapq
+import http.server
+import threading
 
 INTERVAL = 5 * 60
+# Counters are sampled every TICK seconds within an interval
+TICK = 1
+# Seconds of samples to extrapolate the rest of an interval from
+WINDOW = 10
 HZ = 1000
 LATENCY = '300ms'
+PROC_NET_DEV = '/proc/net/dev'
+# Assumed when an interface doesn't report its link speed (e.g. virtio), in bytes per second
+MAX_LINK_RATE = 1000 * 1000 * 1000 // 8
+PERCENTILE = 95
+
+# One little-endian u64 byte count per INTERVAL slot of the month, all ones for slots without a sample
+SAMPLE = struct.Struct('<Q')
+EMPTY = 2**64 - 1
+
+def utc(ts: float):
+    # Months and slots are in UTC, local time repeats or skips an hour when the clocks change
+    return datetime.datetime.fromtimestamp(ts, datetime.timezone.utc)
 
 def end_of_month(dt: datetime.datetime):
-    return datetime.datetime(dt.year, dt.month + 1 if dt.month != 12 else 1, 1) - datetime.timedelta(seconds=1)
+    if dt.month == 12:
+        return datetime.datetime(dt.year + 1, 1, 1, tzinfo=dt.tzinfo) - datetime.timedelta(seconds=1)
+    return datetime.datetime(dt.year, dt.month + 1, 1, tzinfo=dt.tzinfo) - datetime.timedelta(seconds=1)
 
 def start_of_month(dt: datetime.datetime):
-    return datetime.datetime(dt.year, dt.month, 1)
+    return datetime.datetime(dt.year, dt.month, 1, tzinfo=dt.tzinfo)
 
 def month_seconds(dt: datetime.datetime):
     return (end_of_month(dt) - start_of_month(dt)).total_seconds()
@@ -24,16 +52,408 @@ def month_seconds(dt: datetime.datetime):
 def month_fraction(dt: datetime.datetime):
     return (dt - start_of_month(dt)).total_seconds() / month_seconds(dt)
 
+def month_slots(dt: datetime.datetime):
+    return (int(month_seconds(dt)) + 1) // INTERVAL
+
+def month_slot(dt: datetime.datetime):
+    return int((dt - start_of_month(dt)).total_seconds()) // INTERVAL
+
+def read_counters():
+    # All interfaces in a single read, no need to fork `ip` for each one
+    counters = {}
+    with open(PROC_NET_DEV, 'r') as f:
+        for line in f.readlines()[2:]:
+            name, stats = line.split(':', 1)
+            stats = stats.split()
+            counters[name.strip()] = {'rx': int(stats[0]), 'tx': int(stats[8])}
+    return counters
+
+def link_rate(iface: str):
+    try:
+        with open(f'/sys/class/net/{iface}/speed', 'r') as f:
+            speed = int(f.read())
+    except (OSError, ValueError):
+        return MAX_LINK_RATE
+    return speed * 1000 * 1000 // 8 if speed > 0 else MAX_LINK_RATE
+
+def counter_delta(prev: int, cur: int, max_delta: int):
+    '''Bytes counted between two reads, `max_delta` being the most the link could have moved in between'''
+    if cur >= prev:
+        return cur - prev
+    if prev < 2**32 and cur + 2**32 - prev <= max_delta:
+        # 32-bit counter wrapped
+        return cur + 2**32 - prev
+    # Counter was reset (e.g. interface recreated), everything since then is new
+    return cur
+
+def wait_for_boundary(interval: int):
+    # Re-aligned to the wall clock every time, but sleeping on the monotonic clock
+    wall = time.time()
+    boundary = (wall // interval + 1) * interval
+    deadline = time.monotonic() + (boundary - wall)
+    while (remaining := deadline - time.monotonic()) > 0:
+        time.sleep(remaining)
+    return boundary
+
+class SampleStore:
+    '''
+    Memory-mapped `<year>/<month>.u64` file with a fixed slot for every interval of the month,
+    so recording a sample is a single aligned 8-byte store. Inspect with `od -An -tu8 -w8`.
+    '''
+    def __init__(self, basedir: str, dt: datetime.datetime):
+        self.month = (dt.year, dt.month)
+        self.path = os.path.join(basedir, str(dt.year), f'{dt.month}.u64')
+        self.slots = month_slots(dt)
+        size = self.slots * SAMPLE.size
+        if not os.path.exists(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = self.path + '.tmp'
+            with open(tmp, 'wb') as f:
+                f.write(b'\xff' * size)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp, self.path)
+
+        self.file = open(self.path, 'r+b')
+        self.map = mmap.mmap(self.file.fileno(), size)
+
+    def __getitem__(self, slot: int):
+        return SAMPLE.unpack_from(self.map, slot * SAMPLE.size)[0]
+
+    def __setitem__(self, slot: int, value: int):
+        offset = slot * SAMPLE.size
+        SAMPLE.pack_into(self.map, offset, value)
+        # Only the page holding the slot needs to hit the disk
+        page = offset - offset % mmap.PAGESIZE
+        self.map.flush(page, min(mmap.PAGESIZE, len(self.map) - page))
+
+    def samples(self):
+        return [v for (v,) in SAMPLE.iter_unpack(self.map) if v != EMPTY]
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+class Percentile:
+    '''
+    Exact running nearest-rank percentile: samples above it in a min-heap, the rest in a max-heap.
+    Adding a sample is O(log n), reading the percentile O(1).
+    '''
+    def __init__(self, pct: int, samples=()):
+        self.pct = pct
+        self.upper = []
+        self.lower = []
+        for v in samples:
+            self.add(v)
+
+    def __len__(self):
+        return len(self.upper) + len(self.lower)
+
+    def add(self, value: int):
+        if self.upper and value > self.upper[0]:
+            heapq.heappush(self.upper, value)
+        else:
+            heapq.heappush(self.lower, -value)
+
+        # Rank of the percentile is ceil(n * pct / 100), everything past it goes into upper
+        n = len(self)
+        above = n - (n * self.pct + 99) // 100
+        while len(self.upper) > above:
+            heapq.heappush(self.lower, -heapq.heappop(self.upper))
+        while len(self.upper) < above:
+            heapq.heappush(self.upper, -heapq.heappop(self.lower))
+
+    def value(self):
+        return -self.lower[0] if self.lower else 0
+
+def to_mbit(used: int):
+    return used * 8 / 1024 / 1024 / INTERVAL
+
+def to_bytes(mbit: float):
+    return int((mbit / 8) * 1024 * 1024 * INTERVAL)
+
+class Ring:
+    '''Fixed size ring of samples, preallocated so that sampling doesn't allocate'''
+    def __init__(self, size: int):
+        self.samples = array.array('Q', bytes(8 * size))
+        self.pos = 0
+        self.count = 0
+
+    def append(self, value: int):
+        self.samples[self.pos] = value
+        self.pos = (self.pos + 1) % len(self.samples)
+        self.count = min(self.count + 1, len(self.samples))
+
+    def recent(self, n: int):
+        '''Sum of the last `n` samples'''
+        n = min(n, self.count)
+        total = 0
+        for i in range(1, n + 1):
+            total += self.samples[self.pos - i]
+        return total, n
+
+class Month:
+    '''Accounting of the samples recorded so far this month against the 95th percentile commit'''
+    def __init__(self, dt: datetime.datetime, cutoff: int, samples=()):
+        self.month = (dt.year, dt.month)
+        self.slots = month_slots(dt)
+        # Intervals that can go over the cutoff without moving the 95th percentile past it
+        self.allowance = self.slots - (self.slots * PERCENTILE + 99) // 100
+        self.cutoff = cutoff
+        self.p95 = Percentile(PERCENTILE)
+        self.over = 0
+        for v in samples:
+            self.add(v)
+
+    def add(self, used: int):
+        self.p95.add(used)
+        if used > self.cutoff:
+            self.over += 1
+
+class BinaryPolicy:
+    '''Full speed until the 95th percentile so far this month goes over the commit'''
+    def __init__(self, lo: int, hi: int, args: argparse.Namespace):
+        self.lo = lo
+        self.hi = hi
+
+    def rate(self, month: Month, slot: int, used: int):
+        if month.p95.value() > month.cutoff:
+            print(f'warning: {PERCENTILE}th percentile so far this month is {to_mbit(month.p95.value()):.1f}mbps over {len(month.p95)} intervals; applying bandwidth limit')
+            return self.lo
+        return self.hi
+
+    def can_spend(self, month: Month):
+        # Whether one more interval over the cutoff would keep the 95th percentile under it
+        n = len(month.p95) + 1
+        return month.over + 1 <= n - (n * PERCENTILE + 99) // 100
+
+class PredictivePolicy:
+    '''
+    Forecasts how many of the remaining intervals will want to go over the commit from a moving
+    average of recent ones, and scales the rate between lo and hi by how much of that demand the
+    remaining allowance of intervals over the cutoff can cover.
+    '''
+    def __init__(self, lo: int, hi: int, args: argparse.Namespace):
+        self.lo = lo
+        self.hi = hi
+        self.alpha = args.alpha
+        self.reserve = args.reserve
+        self.saturation = args.saturation
+        self.p_hot = 1 - PERCENTILE / 100
+        self.applied = hi
+
+    def rate(self, month: Month, slot: int, used: int):
+        # Intervals spent at a reduced rate that was fully used would have gone over given the chance.
+        # tc's mbit is decimal, unlike the cutoff's
+        hot = used > month.cutoff or (self.applied < self.hi and used >= self.saturation * tbf_params(self.applied)[0] * INTERVAL)
+        self.p_hot += self.alpha * (hot - self.p_hot)
+
+        budget = month.allowance - month.over - self.reserve
+        need = self.p_hot * (month.slots - slot - 1)
+        if budget <= 0:
+            rate = self.lo
+        elif need <= budget:
+            rate = self.hi
+        else:
+            rate = self.lo + (self.hi - self.lo) * budget / need
+        print(f'{month.over}/{month.allowance} intervals over the cutoff, expecting {need:.1f} more; rate {rate:.0f}mbit')
+
+        self.applied = round(rate)
+        return self.applied
+
+    def can_spend(self, month: Month):
+        return month.allowance - month.over - self.reserve > 0
+
+POLICIES = {
+    'binary': BinaryPolicy,
+    'predictive': PredictivePolicy,
+}
+
+def tbf_params(limit: int):
+    # Rate in bytes per second as the kernel reports it, and burst
+    return limit * 1000 * 1000 // 8, int(((limit*1000*1000)/HZ/8) * 4)
+
+def qdisc_rates():
+    rates = {}
+    for q in json.loads(subprocess.check_output(['tc', '-j', 'qdisc', 'show'])):
+        if q.get('root') and q.get('kind') == 'tbf':
+            rates[q['dev']] = q['options']['rate']
+    return rates
+
+def apply_limit(ifaces, limit: int):
+    '''
+    Changes the root tbf qdisc of all interfaces with a single tc process, and returns whether
+    the kernel now reports the new rate on all of them.
+    '''
+    rate, burst = tbf_params(limit)
+    commands = ''.join(f'qdisc change dev {shlex.quote(n)} root tbf rate {limit}mbit burst {burst} latency {LATENCY}\n' for n in ifaces)
+    # -force carries on with the other interfaces if one of them fails
+    subprocess.run(['tc', '-force', '-batch', '-'], input=commands, text=True)
+
+    rates = qdisc_rates()
+    ok = True
+    for n in ifaces:
+        if rates.get(n) != rate:
+            print(f'warning: {n} has rate {rates.get(n)}B/s instead of {rate}B/s')
+            ok = False
+    return ok
+
+def step(month: Month, policy, slot: int, used: int):
+    '''Account an interval that just ended and pick the rate for the next one'''
+    month.add(used)
+    if used > month.cutoff:
+        print(f'used more than {to_mbit(month.cutoff):.0f}mbps over the last {INTERVAL}s')
+    return policy.rate(month, slot, used)
+
+def read_trace(path: str):
+    '''
+    Yields (start of interval, bytes) from either a `<year>/<month>.u64` sample store or a CSV
+    of `time,bytes` rows with unix or ISO 8601 times (UTC unless they have an offset).
+    '''
+    if path.endswith('.u64'):
+        year = int(os.path.basename(os.path.dirname(os.path.abspath(path))))
+        start = datetime.datetime(year, int(os.path.basename(path)[:-4]), 1, tzinfo=datetime.timezone.utc)
+        with open(path, 'rb') as f:
+            for slot, (v,) in enumerate(SAMPLE.iter_unpack(f.read())):
+                if v != EMPTY:
+                    yield start + datetime.timedelta(seconds=slot * INTERVAL), v
+        return
+
+    with open(path, 'r', newline='') as f:
+        for row in csv.reader(f):
+            if not row or not row[1].strip().isdigit():
+                # Header
+                continue
+            t = row[0].strip()
+            if t.replace('.', '', 1).isdigit():
+                dt = utc(float(t))
+            else:
+                dt = datetime.datetime.fromisoformat(t)
+                if dt.tzinfo is None:
+                    dt = dt.replace(tzinfo=datetime.timezone.utc)
+                dt = dt.astimezone(datetime.timezone.utc)
+            yield dt, int(row[1])
+
+def simulate(args: argparse.Namespace):
+    '''
+    Replays recorded per-interval traffic as demand through the same accounting and policy as the
+    limiter. Whatever doesn't fit under the rate picked for an interval is delayed to the next one.
+    Once no intervals over the cutoff are left, intervals are capped at the cutoff as the limiter
+    caps them partway through, as if their demand were spread evenly over them.
+    '''
+    policy = POLICIES[args.policy](args.lo, args.hi, args)
+    cutoff = to_bytes(args.lo)
+    months = {}
+    throttled = {}
+    delayed = {}
+    limit = args.hi
+    backlog = 0
+
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for dt, demand in read_trace(args.trace):
+            key = (dt.year, dt.month)
+            if key not in months:
+                months[key] = Month(dt, cutoff)
+                throttled[key] = 0
+                delayed[key] = 0
+
+            # Delayed traffic goes out first, count only bytes that miss their own interval
+            capacity = tbf_params(limit)[0] * INTERVAL
+            if not policy.can_spend(months[key]):
+                capacity = min(capacity, cutoff)
+            late = demand - max(0, min(demand, capacity - backlog))
+            used = min(demand + backlog, capacity)
+            backlog += demand - used
+            if late:
+                throttled[key] += 1
+                delayed[key] += late
+            limit = step(months[key], policy, month_slot(dt), used)
+    elapsed = time.perf_counter() - started
+
+    for (year, m), month in months.items():
+        p95 = to_mbit(month.p95.value())
+        print(f'{year}-{m:02}: {PERCENTILE}th percentile {p95:.1f}mbps{" (over commit)" if p95 > args.lo else ""}, '
+              f'{month.over}/{month.allowance} intervals over the cutoff, {throttled[(year, m)]} of {len(month.p95)} intervals throttled, '
+              f'{delayed[(year, m)] / 1024 / 1024 / 1024:.2f}GiB delayed')
+    if backlog:
+        print(f'{backlog / 1024 / 1024 / 1024:.2f}GiB still delayed at the end of the trace')
+    print(f'replayed in {elapsed * 1000:.0f}ms')
+
+class MetricsServer:
+    '''
+    Serves the limiter state in the OpenMetrics text format. The page is rendered once per
+    interval by the main loop, scrapes only ever return the last rendering.
+    '''
+    CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+    def __init__(self, listen: str):
+        host, _, port = listen.rpartition(':')
+        self.page = b'# EOF\n'
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                page = server.page
+                self.send_response(200)
+                self.send_header('Content-Type', server.CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(page)))
+                self.end_headers()
+                self.wfile.write(page)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = http.server.ThreadingHTTPServer((host.strip('[]'), int(port)), Handler)
+        self.httpd.daemon_threads = True
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def update(self, families):
+        '''`families` is a list of (name, type, unit, help, [(labels, value)])'''
+        lines = []
+        for name, kind, unit, help, samples in families:
+            lines.append(f'# TYPE {name} {kind}')
+            if unit:
+                lines.append(f'# UNIT {name} {unit}')
+            lines.append(f'# HELP {name} {help}')
+            for labels, value in samples:
+                label_str = ','.join(f'{k}="{v}"' for k, v in labels.items())
+                lines.append(f'{name}{"_total" if kind == "counter" else ""}{"{" + label_str + "}" if label_str else ""} {value}')
+        lines.append('# EOF\n')
+        self.page = '\n'.join(lines).encode('utf-8')
+
+def add_policy_args(parser: argparse.ArgumentParser):
+    parser.add_argument('lo', type=int, help='95th percentile commit in mbit')
+    parser.add_argument('hi', type=int, help='burst rate in mbit')
+    parser.add_argument('--policy', choices=POLICIES, default='binary', help='how to pick the rate for the next interval')
+    parser.add_argument('--alpha', type=float, default=0.02, help='predictive: smoothing factor of the average of intervals over the cutoff')
+    parser.add_argument('--reserve', type=int, default=2, help='predictive: intervals over the cutoff held back for the end of the month')
+    parser.add_argument('--saturation', type=float, default=0.95, help='predictive: fraction of a reduced rate counting as wanting more')
+
 def main():
-    if len(sys.argv) != 4:
-        print(f'usage: {sys.argv[0]} <interfaces> <95% limit mbit> <hi limit mbit>')
-        sys.exit(1)
+    if sys.argv[1:2] == ['simulate']:
+        parser = argparse.ArgumentParser(prog=f'{sys.argv[0]} simulate', description='Replay a traffic trace through a limiter policy')
+        parser.add_argument('trace', help='sample store (<year>/<month>.u64) or CSV of time,bytes per interval')
+        add_policy_args(parser)
+        simulate(parser.parse_args(sys.argv[2:]))
+        return
+
+    parser = argparse.ArgumentParser(description='Keep the 95th percentile of transmitted traffic under a commit rate',
+                                     epilog=f'Use `{sys.argv[0]} simulate -h` to replay a trace offline.')
+    parser.add_argument('interfaces', help='comma separated interfaces to measure and limit')
+    add_policy_args(parser)
+    parser.add_argument('--metrics', metavar='ADDRESS:PORT', help='serve OpenMetrics on http://ADDRESS:PORT/metrics')
+    args = parser.parse_args()
 
-    ifaces = sys.argv[1].split(',')
-    lo = int(sys.argv[2])
-    hi = int(sys.argv[3])
+    ifaces = args.interfaces.split(',')
+    lo = args.lo
+    hi = args.hi
+    policy = POLICIES[args.policy](lo, hi, args)
 
-    cutoff = int((lo / 8) * 1024 * 1024 * INTERVAL)
+    cutoff = to_bytes(lo)
 
     basedir = os.environ['STATE_DIRECTORY']
 
@@ -41,48 +461,122 @@ def main():
         sys.exit(0)
     signal.signal(signal.SIGTERM, sig_handler)
 
-    last_total = 0
+    metrics = MetricsServer(args.metrics) if args.metrics else None
+
+    store = None
+    month = None
+    def open_month(dt: datetime.datetime):
+        nonlocal store, month
+        if store is None or store.month != (dt.year, dt.month):
+            if store is not None:
+                store.close()
+            store = SampleStore(basedir, dt)
+            month = Month(dt, cutoff, store.samples())
+
+    applied = None
+    capped = False
+    ring = Ring(INTERVAL // TICK)
+    bucket = int(time.time()) // INTERVAL
+    open_month(utc(bucket * INTERVAL))
+    # Latest bucket written by this run
+    newest = -1
+    used = 0
+    deltas = {}
+    # Twice a tick's worth at link speed, for ticks that are late
+    max_deltas = {}
+    last = read_counters()
     while True:
-        now = datetime.datetime.now()
+        tick = wait_for_boundary(TICK)
 
-        total = 0
+        counters = read_counters()
+        latency = time.time() - tick
+        sample = 0
         for n in ifaces:
-            output = subprocess.check_output(['ip', '-j', '-s', 'link', 'show', 'dev', n], encoding='utf-8')
-            stats = json.loads(output)
-            total += stats[0]['stats64']['tx']['bytes']
-
-        if last_total == 0:
-            last_total = total
+            if n not in counters:
+                if n in last:
+                    print(f'warning: interface {n} has disappeared')
+                    del last[n]
+                    max_deltas.pop(n, None)
+                continue
+            prev = last.get(n, counters[n])
+            if n not in max_deltas:
+                max_deltas[n] = link_rate(n) * TICK * 2
+            d = deltas.setdefault(n, {'rx': 0, 'tx': 0})
+            d['rx'] += counter_delta(prev['rx'], counters[n]['rx'], max_deltas[n])
+            tx = counter_delta(prev['tx'], counters[n]['tx'], max_deltas[n])
+            d['tx'] += tx
+            sample += tx
+            last[n] = counters[n]
+        ring.append(sample)
+        used += sample
 
-        data_file = os.path.join(basedir, str(now.year), f'{now.month}.json')
-        os.makedirs(os.path.dirname(data_file), exist_ok=True)
+        if int(tick) // INTERVAL == bucket:
+            if used > cutoff:
+                # Over the cutoff anyway. With no intervals to spare this is the one setting the
+                # percentile, so the cap stays until the interval ends
+                continue
+            if capped or policy.can_spend(month):
+                continue
+            remaining = (bucket + 1) * INTERVAL - tick
+            recent, n = ring.recent(WINDOW // TICK)
+            if n and used + recent / (n * TICK) * remaining > cutoff:
+                # Land exactly on the cutoff, in tc's decimal mbit
+                cap = max(1, int((cutoff - used) * 8 / 1000 / 1000 / remaining))
+                if applied is None or cap < applied:
+                    print(f'interval is heading over {lo}mbps with no intervals to spare, limiting to {cap}mbit for the last {remaining:.0f}s')
+                    applied = cap if apply_limit(ifaces, cap) else None
+                    capped = True
+            continue
 
-        data = {
-            'hi_fraction_used': 0.0,
-        }
-        if os.path.exists(data_file):
-            with open(data_file, 'r') as f:
-                data = json.load(f)
+        # The bucket that just ended
+        ended = bucket
+        now = utc(ended * INTERVAL)
+        bucket = int(tick) // INTERVAL
+        capped = False
+        open_month(now)
 
-        if total - last_total > cutoff:
-            print(f'used more than {lo}mbps over the last {INTERVAL}s')
-            data['hi_fraction_used'] += INTERVAL / month_seconds(now)
+        slot = month_slot(now)
+        if store[slot] != EMPTY:
+            if ended <= newest:
+                # Clock went backwards, fold this sample into the existing one
+                used += store[slot]
+            else:
+                # Left by an earlier run, keep the larger one
+                used = max(used, store[slot])
+            store[slot] = EMPTY
+            month = Month(now, cutoff, store.samples())
+        store[slot] = used
+        newest = max(newest, ended)
 
-        limit = hi
-        mf = month_fraction(now)
-        if data['hi_fraction_used'] >= mf:
-            print(f"warning: used too many 5% buckets so far {data['hi_fraction_used']} and we are {mf} into the month); applying bandwidth limit")
-            limit = lo
+        limit = step(month, policy, slot, used)
 
-        with open(data_file, 'w') as f:
-            json.dump(data, f)
+        if limit != applied:
+            # Retried next interval if it didn't stick
+            applied = limit if apply_limit(ifaces, limit) else None
 
-        qdisc_args = ['rate', f'{limit}mbit', 'burst', str(int(((limit*1000*1000)/HZ/8) * 4)), 'latency', LATENCY]
-        for n in ifaces:
-            subprocess.check_call(['tc', 'qdisc', 'change', 'dev', n, 'root', 'tbf'] + qdisc_args)
+        if metrics:
+            metrics.update([
+                ('bandwidth_interface_bytes', 'counter', 'bytes', 'Bytes transferred by each interface',
+                 [({'interface': n, 'direction': d}, counters[n][d]) for n in deltas if n in counters for d in ('rx', 'tx')]),
+                ('bandwidth_interval_rate_bits_per_second', 'gauge', 'bits_per_second', 'Average rate over the last interval',
+                 [({'interface': n, 'direction': d}, v * 8 / INTERVAL) for n in deltas for d, v in deltas[n].items()]),
+                ('bandwidth_hi_fraction_used', 'gauge', '', 'Fraction of the month spent over the commit',
+                 [({}, month.over * INTERVAL / month_seconds(now))]),
+                ('bandwidth_month_fraction', 'gauge', '', 'Fraction of the month elapsed',
+                 [({}, month_fraction(now))]),
+                ('bandwidth_intervals_over', 'gauge', '', 'Intervals over the commit this month',
+                 [({'limit': 'used'}, month.over), ({'limit': 'allowed'}, month.allowance)]),
+                ('bandwidth_percentile_rate_bits_per_second', 'gauge', 'bits_per_second', f'{PERCENTILE}th percentile of the month so far',
+                 [({}, month.p95.value() * 8 / INTERVAL)]),
+                ('bandwidth_applied_rate_bits_per_second', 'gauge', 'bits_per_second', 'Rate of the tbf qdiscs (0 if it failed to apply)',
+                 [({}, (applied or 0) * 1000 * 1000)]),
+                ('bandwidth_sample_latency_seconds', 'gauge', 'seconds', 'Delay between the end of the interval and reading the counters',
+                 [({}, latency)]),
+            ])
 
-        last_total = total
-        time.sleep(INTERVAL)
+        open_month(utc(bucket * INTERVAL))
+        used = 0
+        deltas = {}
 
 if __name__ == '__main__':
     main()
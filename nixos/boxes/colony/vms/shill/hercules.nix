@@ -35,6 +35,9 @@
             [gc]
             threshold = 256000
             stop = 204800
+            strategy = closure
+            index = /var/lib/nix-cache-gc/index.sqlite
+            checkpoint = /var/lib/nix-cache-gc/checkpoint.jsonl
 
             [s3]
             endpoint = s3.nul.ie
@@ -47,6 +50,7 @@
           path = [ (pkgs.python310.withPackages (ps: with ps; [ minio ])) ];
           serviceConfig = {
             Type = "oneshot";
+            StateDirectory = "nix-cache-gc";
             ExecStart = [ ''${./nix_cache_gc.py} -c ${configFile} -c ${config.age.secrets."nix-cache-gc.ini".path}'' ];
           };
         };
@@ -1,15 +1,33 @@
 #!/usr/bin/env python
 import re
+import os
 import argparse
+import datetime
+import glob
+import gzip
+import heapq
 import configparser
+import json
+import queue
 import sys
 import signal
+import sqlite3
+import tempfile
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import minio
+import urllib3
 
 re_filename_filter = re.compile(r'^(\S+\.narinfo|nar\/\S+\.nar\.\S+)$')
 re_narinfo_line = re.compile(r'^(\S+): (.*)$')
-re_nix_path_hash = re.compile(r'^([0123456789abcdfghijklmnpqrsvwxyz]+)-.+$')
+NIX_BASE32 = '0123456789abcdfghijklmnpqrsvwxyz'
+re_nix_path_hash = re.compile(f'^([{NIX_BASE32}]+)-.+$')
+# nginx "combined" log format
+re_nginx_line = re.compile(r'^\S+ \S+ \S+ \[([^\]]+)\] "(GET|HEAD) (\S+) [^"]*" (\d+) ')
 
 def parse_narinfo(data):
     lines = data.decode('utf-8').split('\n')
@@ -38,8 +56,639 @@ def parse_narinfo(data):
         vals[key] = val
     return vals
 
+class Candidate:
+    '''Just what's needed of a listed object, ordered newest first so a heapq heap keeps the newest on top'''
+    __slots__ = ('last_modified', 'name', 'size')
+
+    def __init__(self, obj):
+        self.last_modified = obj.last_modified
+        self.name = obj.object_name
+        self.size = obj.size
+
+    def __lt__(self, other):
+        return (self.last_modified, self.name) > (other.last_modified, other.name)
+
+def oldest_objects(objs, need):
+    '''
+    Smallest set of the oldest objects (ties broken by name) adding up to at least `need` bytes, oldest
+    first. Only the candidates are kept in memory, plus whatever object is being looked at.
+    '''
+    heap = []
+    size = 0
+    for obj in objs:
+        c = Candidate(obj)
+        if size >= need and not heap[0] < c:
+            # Newer than everything that has to go already
+            continue
+        heapq.heappush(heap, c)
+        size += c.size
+        while size - heap[0].size >= need:
+            size -= heapq.heappop(heap).size
+    return sorted(heap, reverse=True), size
+
+def shard_bounds(depth):
+    '''Keys splitting the bucket into shards on the first `depth` characters of the hashes at the root and in nar/'''
+    prefixes = ['']
+    for _ in range(depth):
+        prefixes = [p + c for p in prefixes for c in NIX_BASE32]
+    return sorted({b for p in prefixes for b in (p, 'nar/' + p) if b})
+
+# Objects handed over from a shard's listing thread at a time
+SHARD_CHUNK = 1000
+
+def list_sharded(mio, bucket, workers, depth, start_after=None):
+    '''
+    Lists the bucket in the same order as a single listing, but as shards listed concurrently.
+    Each shard covers (bound, next bound] using start_after, so the shards exactly partition the
+    bucket whatever the keys are. Up to `workers` shards are listed at once, each handing over
+    chunks of SHARD_CHUNK objects and getting at most one chunk ahead of the reader, so about
+    `workers` * (2 * SHARD_CHUNK + one listing page) objects are held in memory however big the
+    bucket is.
+    '''
+    if workers <= 1:
+        yield from mio.list_objects(bucket, recursive=True, start_after=start_after)
+        return
+
+    stopped = threading.Event()
+    def put(q, item):
+        # Gives up once the listing isn't being read any more
+        while not stopped.is_set():
+            try:
+                q.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def shard(q, after, until):
+        try:
+            chunk = []
+            for obj in mio.list_objects(bucket, recursive=True, start_after=after):
+                if until is not None and obj.object_name > until:
+                    break
+                chunk.append(obj)
+                if len(chunk) >= SHARD_CHUNK:
+                    if not put(q, chunk):
+                        return
+                    chunk = []
+            if chunk and not put(q, chunk):
+                return
+        except Exception as ex:
+            put(q, ex)
+            return
+        put(q, None)
+
+    def drain(q):
+        while (item := q.get()) is not None:
+            if isinstance(item, Exception):
+                raise item
+            yield from item
+
+    bounds = [None] + shard_bounds(depth) + [None]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            pending = deque()
+            for after, until in zip(bounds, bounds[1:]):
+                if start_after is not None:
+                    if until is not None and until <= start_after:
+                        continue
+                    if after is None or after < start_after:
+                        after = start_after
+                q = queue.Queue(1)
+                executor.submit(shard, q, after, until)
+                pending.append(q)
+                if len(pending) >= workers:
+                    yield from drain(pending.popleft())
+            while pending:
+                yield from drain(pending.popleft())
+        finally:
+            stopped.set()
+
+def fetch_narinfo(mio, bucket, name):
+    try:
+        resp = mio.get_object(bucket, name)
+    except minio.error.S3Error as ex:
+        if ex.code == 'NoSuchKey':
+            # Deleted since it was listed
+            return None
+        raise
+    try:
+        return parse_narinfo(resp.read())
+    finally:
+        resp.close()
+        resp.release_conn()
+
+def read_accesses(paths, bucket):
+    '''
+    Yields (object name, unix time) of successful reads of cache objects from nginx access logs
+    (cache vhost, or path style S3 requests) or MinIO audit logs, optionally gzipped.
+    '''
+    for path in paths:
+        with (gzip.open if path.endswith('.gz') else open)(path, 'rt', errors='replace') as f:
+            for line in f:
+                if line.startswith('{'):
+                    try:
+                        entry = json.loads(line)
+                        api = entry['api']
+                    except (ValueError, KeyError):
+                        continue
+                    if api.get('name') not in ('GetObject', 'HeadObject') or api.get('bucket') != bucket \
+                            or api.get('statusCode', 500) >= 400:
+                        continue
+                    name = api.get('object', '')
+                    # Nanosecond precision isn't understood by fromisoformat()
+                    t = datetime.datetime.fromisoformat(entry['time'][:19]).replace(tzinfo=datetime.timezone.utc)
+                else:
+                    m = re_nginx_line.match(line)
+                    if not m or int(m.group(4)) >= 400:
+                        continue
+                    name = m.group(3).split('?', 1)[0].lstrip('/')
+                    if name.startswith(bucket + '/'):
+                        name = name[len(bucket) + 1:]
+                    t = datetime.datetime.strptime(m.group(1), '%d/%b/%Y:%H:%M:%S %z')
+
+                if re_filename_filter.match(name):
+                    yield name, t.timestamp()
+
+# Eviction order for each policy, `{size}` being the size of whatever is evicted as a unit
+RECENCY = 'MAX(o.last_modified, COALESCE(a.last_access, 0))'
+POLICIES = {
+    # Upload time
+    'age': 'o.last_modified, o.name',
+    'lru': f'{RECENCY}, o.name',
+    'lfu': f'COALESCE(a.hits, 0), {RECENCY}, o.name',
+    # GreedyDual-Size-Frequency, with a uniform cost of fetching an object again
+    'gdsf': f'COALESCE(a.hits, 0) * 1.0 / MAX({{size}}, 1), {RECENCY}, o.name',
+}
+
+def fetch_narinfos(mio, bucket, objs, workers):
+    '''Yields (object, parsed narinfo) in order, with up to a few times `workers` fetches in flight'''
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for obj in objs:
+            pending.append((obj, executor.submit(fetch_narinfo, mio, bucket, obj.object_name)))
+            if len(pending) >= workers * 4:
+                obj, f = pending.popleft()
+                yield obj, f.result()
+        while pending:
+            obj, f = pending.popleft()
+            yield obj, f.result()
+
+# NARs this recent may just not have had their narinfo uploaded yet, and narinfos this recent may
+# point at a NAR uploaded after its part of the bucket was listed
+CHECK_GRACE = datetime.timedelta(hours=1)
+
+def check_consistency(objs, mio, bucket, workers, partitions, verbose):
+    '''
+    Finds NARs no narinfo points at, and narinfos whose NAR is missing, leaving out anything
+    uploaded in the last CHECK_GRACE. This is a hash join of narinfo URLs against NAR names. Both
+    sides are spilled to `partitions` files by hash of the NAR name, so only one partition of NARs
+    is ever held in memory.
+    Returns lists of (name, size) of orphaned NARs and dangling narinfos.
+    '''
+    now = datetime.datetime.now(datetime.timezone.utc)
+    with tempfile.TemporaryDirectory(prefix='nix-cache-check-') as tmp:
+        def open_partitions(side):
+            return [open(os.path.join(tmp, f'{side}-{i}'), 'w') for i in range(partitions)]
+        nar_parts = open_partitions('nars')
+        url_parts = open_partitions('urls')
+        def partition(name):
+            return zlib.crc32(name.encode('utf-8')) % partitions
+
+        counts = {'nars': 0, 'narinfos': 0}
+        def narinfo_objs():
+            for obj in objs:
+                name = obj.object_name
+                if name.endswith('.narinfo'):
+                    yield obj
+                elif name.startswith('nar/'):
+                    recent = int(now - obj.last_modified < CHECK_GRACE)
+                    nar_parts[partition(name)].write(f'{name}\t{obj.size}\t{recent}\n')
+                    counts['nars'] += 1
+
+        dangling = []
+        for obj, info in fetch_narinfos(mio, bucket, narinfo_objs(), workers):
+            counts['narinfos'] += 1
+            if info is None:
+                continue
+            url = info.get('URL')
+            if not url:
+                log(f'{obj.object_name} has no URL')
+                continue
+            recent = int(now - obj.last_modified < CHECK_GRACE)
+            url_parts[partition(url)].write(f'{url}\t{obj.object_name}\t{obj.size}\t{recent}\n')
+        verbose(f'Listed {counts["nars"]} NARs and {counts["narinfos"]} narinfos')
+
+        orphans = []
+        for i in range(partitions):
+            nar_parts[i].close()
+            url_parts[i].close()
+            nars = {}
+            with open(nar_parts[i].name, 'r') as f:
+                for line in f:
+                    name, size, recent = line.rstrip('\n').split('\t')
+                    nars[name] = [int(size), recent == '1', False]
+            with open(url_parts[i].name, 'r') as f:
+                for line in f:
+                    url, name, size, recent = line.rstrip('\n').split('\t')
+                    if url in nars:
+                        nars[url][2] = True
+                    elif recent != '1':
+                        dangling.append((name, int(size)))
+            orphans.extend((name, size) for name, (size, recent, used) in nars.items() if not used and not recent)
+            os.unlink(nar_parts[i].name)
+            os.unlink(url_parts[i].name)
+
+    return orphans, dangling
+
+INDEX_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS objects (
+    name TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    last_modified REAL NOT NULL,
+    etag TEXT,
+    -- Listing generation the object was last seen in
+    seen INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS objects_age ON objects (last_modified, name);
+
+CREATE TABLE IF NOT EXISTS narinfos (
+    name TEXT PRIMARY KEY,
+    -- ETag of the object this was parsed from
+    etag TEXT,
+    store_path TEXT,
+    url TEXT,
+    file_size INTEGER,
+    nar_size INTEGER
+);
+CREATE INDEX IF NOT EXISTS narinfos_url ON narinfos (url);
+
+CREATE TABLE IF NOT EXISTS refs (
+    narinfo TEXT NOT NULL,
+    ref TEXT NOT NULL,
+    PRIMARY KEY (narinfo, ref)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS refs_ref ON refs (ref);
+
+CREATE TABLE IF NOT EXISTS state (
+    key TEXT PRIMARY KEY,
+    value
+);
+
+-- Filled from access logs on every run
+CREATE TEMP TABLE accesses (
+    name TEXT PRIMARY KEY,
+    hits INTEGER NOT NULL,
+    last_access REAL NOT NULL
+);
+'''
+INDEX_BATCH = 1000
+ACCESS_BATCH = 100000
+
+class Index:
+    '''
+    SQLite index of the cache's objects and parsed narinfos. Refreshing it lists the bucket again
+    (resuming an interrupted listing with start_after) but only fetches narinfos it hasn't seen.
+    '''
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode = WAL')
+        self.db.executescript(INDEX_SCHEMA)
+
+    def get_state(self, key, default=None):
+        row = self.db.execute('SELECT value FROM state WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_state(self, key, value):
+        self.db.execute('INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)', (key, value))
+
+    def add_objects(self, objs, generation):
+        names = [o.object_name for o in objs]
+        known = {}
+        for i in range(0, len(names), 500):
+            chunk = names[i:i+500]
+            known.update((n, (size, etag)) for n, size, etag in self.db.execute(
+                f'SELECT name, size, etag FROM objects WHERE name IN ({",".join("?" * len(chunk))})', chunk))
+
+        new = sum(1 for n in names if n not in known)
+        changed = sum(1 for o in objs if o.object_name in known and known[o.object_name] != (o.size, o.etag))
+        self.db.executemany('''
+            INSERT INTO objects (name, size, last_modified, etag, seen) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (name) DO UPDATE SET
+                size = excluded.size, last_modified = excluded.last_modified, etag = excluded.etag, seen = excluded.seen
+        ''', ((o.object_name, o.size, o.last_modified.timestamp(), o.etag, generation) for o in objs))
+        return new, changed
+
+    def forget(self, names):
+        for i in range(0, len(names), 500):
+            chunk = names[i:i+500]
+            placeholders = ",".join("?" * len(chunk))
+            self.db.execute(f'DELETE FROM objects WHERE name IN ({placeholders})', chunk)
+            self.db.execute(f'DELETE FROM narinfos WHERE name IN ({placeholders})', chunk)
+            self.db.execute(f'DELETE FROM refs WHERE narinfo IN ({placeholders})', chunk)
+        self.db.commit()
+
+    def refresh_objects(self, listing, verbose):
+        generation = self.get_state('generation', 0)
+        start_after = self.get_state('list_after')
+        if start_after is None:
+            generation += 1
+            self.set_state('generation', generation)
+            self.db.commit()
+        else:
+            log(f'Resuming interrupted listing after {start_after}')
+
+        new = changed = 0
+        batch = []
+        def flush():
+            nonlocal new, changed
+            n, c = self.add_objects(batch, generation)
+            new += n
+            changed += c
+            # Committed together with where the listing got to
+            self.set_state('list_after', batch[-1].object_name)
+            self.db.commit()
+            batch.clear()
+
+        listed = 0
+        for obj in listing(start_after):
+            if not re_filename_filter.match(obj.object_name):
+                continue
+            batch.append(obj)
+            if len(batch) >= INDEX_BATCH:
+                flush()
+                listed += INDEX_BATCH
+                verbose(f'Listed {listed} objects')
+        if batch:
+            flush()
+
+        gone = [n for (n,) in self.db.execute('SELECT name FROM objects WHERE seen < ?', (generation,))]
+        self.forget(gone)
+        self.db.execute('DELETE FROM state WHERE key = ?', ('list_after',))
+        self.db.commit()
+        log(f'Index has {new} new, {changed} changed and {len(gone)} removed objects')
+        return new, changed, len(gone)
+
+    def add_narinfo(self, name, etag, info):
+        self.db.execute('''
+            INSERT OR REPLACE INTO narinfos (name, etag, store_path, url, file_size, nar_size) VALUES (?, ?, ?, ?, ?, ?)
+        ''', (name, etag, info.get('StorePath'), info.get('URL'), info.get('FileSize'), info.get('NarSize')))
+        self.db.execute('DELETE FROM refs WHERE narinfo = ?', (name,))
+        self.db.executemany('INSERT INTO refs (narinfo, ref) VALUES (?, ?)',
+                            ((name, r) for r in info.get('References', set()) if r != name))
+
+    def refresh_narinfos(self, mio, bucket, workers, verbose, reconcile=False):
+        '''
+        Fetches narinfos that are new or changed since they were parsed. With `reconcile`, all of
+        them are fetched again and any that differ from the index are reported.
+        '''
+        if reconcile:
+            query = "SELECT o.name, o.etag FROM objects o WHERE o.name LIKE '%.narinfo'"
+        else:
+            query = '''
+                SELECT o.name, o.etag FROM objects o LEFT JOIN narinfos n ON n.name = o.name
+                WHERE o.name LIKE '%.narinfo' AND (n.name IS NULL OR n.etag IS NOT o.etag)
+            '''
+        todo = self.db.execute(query).fetchall()
+
+        drift = 0
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for i in range(0, len(todo), INDEX_BATCH):
+                batch = todo[i:i+INDEX_BATCH]
+                infos = executor.map(lambda t: fetch_narinfo(mio, bucket, t[0]), batch)
+                for (name, etag), info in zip(batch, infos):
+                    if info is None:
+                        self.forget([name])
+                        continue
+                    if reconcile:
+                        row = self.db.execute('SELECT url, nar_size FROM narinfos WHERE name = ?', (name,)).fetchone()
+                        refs = {r for (r,) in self.db.execute('SELECT ref FROM refs WHERE narinfo = ?', (name,))}
+                        if row and (row != (info.get('URL'), info.get('NarSize')) or refs != info.get('References', set()) - {name}):
+                            log(f'{name} differs from the index')
+                            drift += 1
+                    self.add_narinfo(name, etag, info)
+                self.db.commit()
+                verbose(f'Fetched {i + len(batch)}/{len(todo)} narinfos')
+        return drift
+
+    def load_accesses(self, accesses):
+        '''Aggregates (name, time) pairs into the access table, a batch at a time'''
+        total = 0
+        batch = {}
+        def flush():
+            self.db.executemany('''
+                INSERT INTO accesses (name, hits, last_access) VALUES (?, ?, ?)
+                ON CONFLICT (name) DO UPDATE SET
+                    hits = hits + excluded.hits, last_access = MAX(last_access, excluded.last_access)
+            ''', ((n, h, t) for n, (h, t) in batch.items()))
+            batch.clear()
+
+        for name, t in accesses:
+            total += 1
+            entry = batch.get(name)
+            if entry:
+                entry[0] += 1
+                entry[1] = max(entry[1], t)
+            else:
+                batch[name] = [1, t]
+            if len(batch) >= ACCESS_BATCH:
+                flush()
+        flush()
+        self.db.commit()
+        return total
+
+    def has(self, name):
+        return self.db.execute('SELECT 1 FROM objects WHERE name = ?', (name,)).fetchone() is not None
+
+    def total_size(self):
+        return self.db.execute('SELECT COALESCE(SUM(size), 0) FROM objects').fetchone()[0]
+
+    def oldest(self, need, policy='age'):
+        to_delete = []
+        free_size = 0
+        order = POLICIES[policy].format(size='o.size')
+        for name, size in self.db.execute(f'SELECT o.name, o.size FROM objects o LEFT JOIN accesses a ON a.name = o.name ORDER BY {order}'):
+            if free_size >= need:
+                break
+            to_delete.append(name)
+            free_size += size
+        return to_delete, free_size
+
+    def closure(self, need, verbose, policy='age'):
+        '''
+        Picks narinfos in the order of the policy, but only ones that no remaining narinfo refers
+        to, so that no remaining narinfo ever has missing references. Narinfos passed over for
+        still being referred to are picked up as soon as everything referring to them has gone, if
+        that happens before enough has been picked. Each narinfo goes together with its NAR, and
+        NARs without any narinfo pointing at them are ranked on their own.
+        Returns the narinfos and NARs to delete, and how much that frees.
+        '''
+        order = POLICIES[policy].format(size='o.size + COALESCE(nar.size, 0)')
+        roots = self.db.execute(f'''
+            SELECT o.name, o.size, n.name IS NULL, n.url, nar.size FROM objects o
+            LEFT JOIN narinfos n ON n.name = o.name
+            LEFT JOIN objects nar ON nar.name = n.url
+            LEFT JOIN accesses a ON a.name = o.name
+            WHERE n.name IS NOT NULL
+                OR (o.name LIKE 'nar/%' AND NOT EXISTS (SELECT 1 FROM narinfos u WHERE u.url = o.name))
+            ORDER BY {order}
+        ''')
+        # Other narinfos still in the bucket referring to each narinfo
+        referrers = dict(self.db.execute('''
+            SELECT r.ref, COUNT(*) FROM refs r
+            JOIN objects o ON o.name = r.narinfo
+            WHERE r.ref != r.narinfo
+            GROUP BY r.ref
+        '''))
+
+        # Passed over while referred to, and those of them that no longer are, by rank
+        blocked = {}
+        ready = []
+        nar_users = {}
+        to_delete_narinfos = []
+        to_delete_nars = []
+        free_size = 0
+
+        def take(name, size, orphan, url, nar_size):
+            nonlocal free_size
+            free_size += size
+            if orphan:
+                to_delete_nars.append(name)
+                verbose(f'Going to delete orphaned {name}')
+                return
+            to_delete_narinfos.append(name)
+            verbose(f'Going to delete {name} ({url})')
+            if nar_size is not None:
+                if url not in nar_users:
+                    nar_users[url] = self.db.execute('SELECT COUNT(*) FROM narinfos WHERE url = ?', (url,)).fetchone()[0]
+                nar_users[url] -= 1
+                if nar_users[url] == 0:
+                    to_delete_nars.append(url)
+                    free_size += nar_size
+            for (ref,) in self.db.execute('SELECT ref FROM refs WHERE narinfo = ? AND ref != narinfo', (name,)):
+                referrers[ref] -= 1
+                if referrers[ref] == 0:
+                    del referrers[ref]
+                    if ref in blocked:
+                        heapq.heappush(ready, blocked.pop(ref))
+
+        for rank, row in enumerate(roots):
+            # Anything that became free to go ranks before this
+            while ready and free_size < need:
+                take(*heapq.heappop(ready)[1])
+            if free_size >= need:
+                break
+            if referrers.get(row[0]):
+                blocked[row[0]] = (rank, row)
+                continue
+            take(*row)
+        while ready and free_size < need:
+            take(*heapq.heappop(ready)[1])
+
+        verbose(f'Up to {free_size/1024/1024}MiB')
+        return to_delete_narinfos, to_delete_nars, free_size
+
+# Most keys a DeleteObjects request can take
+DELETE_BATCH = 1000
+
+class Checkpoint:
+    '''
+    Deletion plan of a run, followed by a line for each batch that has been deleted, so that an
+    interrupted run can be picked up where it left off.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return None
+        with open(self.path, 'r') as f:
+            plan = json.loads(f.readline())['plan']
+            done = set()
+            for line in f:
+                try:
+                    done.update(json.loads(line)['done'])
+                except ValueError:
+                    # Torn last line
+                    break
+        return [k for k in plan if k not in done]
+
+    def start(self, keys):
+        if not self.path:
+            return
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(json.dumps({'plan': keys}) + '\n')
+        os.rename(tmp, self.path)
+        self.file = open(self.path, 'a')
+
+    def done(self, keys):
+        if self.file:
+            self.file.write(json.dumps({'done': keys}) + '\n')
+            self.file.flush()
+
+    def finish(self):
+        if self.file:
+            self.file.close()
+            os.unlink(self.path)
+
+def delete_batch(mio, bucket, keys, retries):
+    '''Deletes up to DELETE_BATCH keys, retrying failed ones with backoff. Returns the keys that couldn't be deleted.'''
+    pending = keys
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(min(30, 0.5 * 2**(attempt - 1)))
+        try:
+            errors = list(mio.remove_objects(bucket, [minio.deleteobjects.DeleteObject(k) for k in pending]))
+        except (minio.error.MinioException, urllib3.exceptions.HTTPError) as ex:
+            log(f'Error while deleting {len(pending)} objects (attempt {attempt + 1}): {ex}')
+            continue
+        if errors:
+            log(f'Failed to delete {len(errors)} of {len(pending)} objects (attempt {attempt + 1}), '
+                f'e.g. {errors[0].name}: {errors[0].code} {errors[0].message}')
+        failed = {err.name for err in errors}
+        pending = [k for k in pending if k in failed]
+        if not pending:
+            break
+    return pending
+
+def delete_objects(mio, bucket, keys, workers, retries, done):
+    '''
+    Deletes `keys` in concurrent batches, all narinfos before any NAR so that a run that stops
+    half way doesn't leave narinfos behind pointing at missing NARs. `done` is called with every
+    batch of deleted keys. Returns the keys that couldn't be deleted.
+    '''
+    narinfos = [k for k in keys if k.endswith('.narinfo')]
+    nars = [k for k in keys if not k.endswith('.narinfo')]
+
+    deleted = 0
+    start = time.monotonic()
+    failed = []
+    for phase in (narinfos, nars):
+        if failed:
+            log(f'Not deleting {len(phase)} NARs as some narinfos are still there')
+            return failed + phase
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {}
+            for i in range(0, len(phase), DELETE_BATCH):
+                batch = phase[i:i+DELETE_BATCH]
+                futures[executor.submit(delete_batch, mio, bucket, batch, retries)] = batch
+            for f in as_completed(futures):
+                batch = futures[f]
+                pending = set(f.result())
+                failed.extend(pending)
+                done([k for k in batch if k not in pending])
+
+                deleted += len(batch) - len(pending)
+                elapsed = time.monotonic() - start
+                log(f'Deleted {deleted}/{len(keys)} objects ({deleted/elapsed:.0f}/s)')
+    return failed
+
 def log(message):
-    print(message, file=sys.stderr)
+    # One write, as deletion logs from multiple threads
+    sys.stderr.write(message + '\n')
     sys.stderr.flush()
 
 def main():
@@ -51,6 +700,16 @@ def main():
     parser.add_argument('-c', '--config', required=True, action='append', help='config file')
     parser.add_argument('-d', '--dry-run', action='store_true', help="don't actually delete anything")
     parser.add_argument('-v', '--verbose', action='store_true', help="log extra info")
+    parser.add_argument('-s', '--strategy', choices=('age', 'closure'), help='override the strategy from the config')
+    parser.add_argument('-r', '--reconcile', action='store_true', help='re-fetch every narinfo and report where the index has drifted')
+    parser.add_argument('-p', '--policy', choices=POLICIES, help='override the eviction policy from the config')
+    parser.add_argument('-a', '--access-log', action='append', default=[], help='nginx or MinIO audit log of cache reads (globs allowed)')
+    parser.add_argument('--compare', action='store_true',
+                        help='report the hit rate each policy would have had over the end of the access logs, and exit')
+    parser.add_argument('--holdout', type=float, default=24, help='hours at the end of the access logs to --compare on')
+    parser.add_argument('--check', action='store_true', help='report orphaned NARs and narinfos pointing at missing NARs, and exit')
+    parser.add_argument('--repair', action='store_true', help='like --check, but also delete what it finds')
+    parser.add_argument('--partitions', type=int, default=64, help='partitions for --check to spill to disk')
 
     args = parser.parse_args()
 
@@ -64,84 +723,144 @@ def main():
     gc_thresh = config.getint('gc', 'threshold')*1024*1024
     gc_stop = config.getint('gc', 'stop')*1024*1024
     assert gc_stop < gc_thresh
+    strategy = args.strategy or config.get('gc', 'strategy', fallback='age')
+    policy = args.policy or config.get('gc', 'policy', fallback='age')
+    access_logs = sorted({p for g in args.access_log + config.get('gc', 'access_logs', fallback='').split() for p in glob.glob(g)})
+    workers = config.getint('gc', 'fetch_workers', fallback=16)
+    # Without a persistent index, the closure strategy has to fetch every narinfo on every run
+    index_path = config.get('gc', 'index', fallback=None)
+    delete_workers = config.getint('gc', 'delete_workers', fallback=4)
+    delete_retries = config.getint('gc', 'delete_retries', fallback=5)
+    checkpoint = Checkpoint(config.get('gc', 'checkpoint', fallback=None))
+    list_workers = config.getint('gc', 'list_workers', fallback=8)
+    list_depth = config.getint('gc', 'list_shard_depth', fallback=1)
+    if args.reconcile and not index_path:
+        # A fresh in-memory index has nothing to compare against
+        log('--reconcile needs [gc] index')
+        sys.exit(1)
 
     s3_special = {'endpoint', 'bucket'}
     s3_ext = dict(filter(lambda i: i[0] not in s3_special, config.items('s3')))
-    mio = minio.Minio(config.get('s3', 'endpoint'), **s3_ext)
+    # Enough pooled connections for every listing, fetching or deleting thread to reuse its own
+    http = urllib3.PoolManager(
+        maxsize=max(workers, delete_workers, list_workers),
+        timeout=urllib3.Timeout(connect=10, read=60),
+        retries=urllib3.Retry(total=5, backoff_factor=0.2, status_forcelist=[500, 502, 503, 504]),
+    )
+    mio = minio.Minio(config.get('s3', 'endpoint'), http_client=http, **s3_ext)
 
     bucket = config.get('s3', 'bucket')
-    objs = list(filter(lambda o: re_filename_filter.match(o.object_name), mio.list_objects(bucket, recursive=True)))
+    def listing(start_after=None):
+        return list_sharded(mio, bucket, list_workers, list_depth, start_after)
+
+    def delete(to_delete, index):
+        checkpoint.start(to_delete)
+        def done(keys):
+            checkpoint.done(keys)
+            if index:
+                index.forget(keys)
+        failed = delete_objects(mio, bucket, to_delete, delete_workers, delete_retries, done)
+        if failed:
+            log(f'Failed to delete {len(failed)} objects, giving up for now')
+            sys.exit(1)
+        checkpoint.finish()
+
+    remaining = checkpoint.load()
+    if remaining:
+        log(f'Resuming interrupted run, {len(remaining)} objects left to delete')
+        if not args.dry_run:
+            delete(remaining, Index(index_path) if index_path else None)
+        return
+
+    if args.check or args.repair:
+        orphans, dangling = check_consistency(listing(), mio, bucket, workers, args.partitions, verbose)
+        for name, _ in orphans:
+            verbose(f'Orphaned NAR {name}')
+        for name, _ in dangling:
+            verbose(f'Dangling narinfo {name}')
+        reclaimable = sum(size for _, size in orphans + dangling)
+        log(f'{len(orphans)} orphaned NARs, {len(dangling)} dangling narinfos, {reclaimable/1024/1024}MiB reclaimable')
+        if args.repair and not args.dry_run:
+            delete([n for n, _ in dangling + orphans], Index(index_path) if index_path else None)
+        return
+
+    index = None
+    if index_path or strategy == 'closure' or args.reconcile or policy != 'age' or args.compare:
+        index = Index(index_path or ':memory:')
+        index.refresh_objects(listing, verbose)
+        total_size = index.total_size()
+    else:
+        def list_objects():
+            return filter(lambda o: re_filename_filter.match(o.object_name), listing())
+        total_size = sum(map(lambda o: o.size, list_objects()))
+
+    if args.reconcile:
+        drift = index.refresh_narinfos(mio, bucket, workers, verbose, reconcile=True)
+        log(f'{drift} narinfos had drifted from the index')
+
+    if args.compare:
+        if not access_logs:
+            log('--compare needs access logs')
+            sys.exit(1)
+        # Rank on everything but the last few hours, and see what would have been hit in those
+        end = max((t for _, t in read_accesses(access_logs, bucket)), default=0)
+        split = end - args.holdout * 3600
+        index.load_accesses((n, t) for n, t in read_accesses(access_logs, bucket) if t < split)
+        future = {}
+        for n, t in read_accesses(access_logs, bucket):
+            if t >= split:
+                future[n] = future.get(n, 0) + 1
+        cached = {n: h for n, h in future.items() if index.has(n)}
+        hits = sum(cached.values())
+        log(f'{hits} reads of cached objects in the last {args.holdout}h of the logs')
+        if strategy == 'closure':
+            index.refresh_narinfos(mio, bucket, workers, verbose)
+        need = max(total_size - gc_stop, 0)
+        for p in POLICIES:
+            if strategy == 'closure':
+                narinfos, nars, free_size = index.closure(need, lambda m: None, p)
+                evicted = set(narinfos + nars)
+            else:
+                evicted, free_size = index.oldest(need, p)
+                evicted = set(evicted)
+            kept = sum(h for n, h in cached.items() if n not in evicted)
+            print(f'{p:>5}: evicts {len(evicted)} objects ({free_size/1024/1024:.1f}MiB), '
+                  f'hit rate {kept / hits if hits else 1:.1%}')
+        return
 
-    total_size = sum(map(lambda o: o.size, objs))
     if total_size < gc_thresh:
         log(f'Cache is only {total_size/1024/1024}MiB, not bothering')
         return
     log(f'Cache is {total_size/1024/1024}MiB, collecting garbage')
 
-    oldest = sorted(objs, key=lambda o: o.last_modified)
-    free_size = 0
-    i = 0
-    to_delete = []
-    while free_size < total_size - gc_stop:
-        obj = oldest[i]
-        free_size += obj.size
-        to_delete.append(obj.object_name)
-        verbose(f'Deleting {obj.object_name}')
+    if access_logs and policy == 'age':
+        log('Ignoring access logs, the age policy only goes by upload time')
+    elif access_logs:
+        n = index.load_accesses(read_accesses(access_logs, bucket))
+        log(f'Loaded {n} reads from {len(access_logs)} access logs')
+
+    if strategy == 'closure':
+        index.refresh_narinfos(mio, bucket, workers, verbose)
+        narinfos, nars, free_size = index.closure(total_size - gc_stop, verbose, policy)
+        # narinfos first, so there is never one pointing at a NAR that's gone
+        to_delete = narinfos + nars
+    elif index:
+        to_delete, free_size = index.oldest(total_size - gc_stop, policy)
+        verbose(f'Up to {free_size/1024/1024}MiB')
+    else:
+        # Second pass, as how much has to go depends on the total
+        oldest, free_size = oldest_objects(list_objects(), total_size - gc_stop)
+        to_delete = []
+        for obj in oldest:
+            to_delete.append(obj.name)
+            verbose(f'Deleting {obj.name}')
         verbose(f'Up to {free_size/1024/1024}MiB')
-        i += 1
 
     log(f'About to delete {len(to_delete)} NARs / narinfos, total size {free_size/1024/1024}MiB')
     if args.dry_run:
         return
 
-    delete_objs = [minio.deleteobjects.DeleteObject(name) for name in to_delete]
-    errors = mio.remove_objects(bucket, delete_objs)
-    for err in errors:
-        log(f'Error while deleting: {err}')
-        sys.exit(1)
-
-    # TODO: Make this smart?
-    #narinfos = sorted(filter(lambda o: o.object_name.endswith('.narinfo'), objs), key=lambda o: o.last_modified)
-    #narinfos_map = {}
-    #def narinfo(name):
-    #    if name not in narinfos_map:
-    #        try:
-    #            resp = mio.get_object(bucket, name)
-    #            info = parse_narinfo(resp.read())
-    #            narinfos_map[name] = info
-    #        finally:
-    #            resp.close()
-    #            resp.release_conn()
-    #    return narinfos_map[name]
-
-    #free_size = 0
-    #to_delete = set()
-    #to_delete_nars = []
-    #def traverse_narinfo(name):
-    #    if name in to_delete:
-    #        return 0
-
-    #    info = narinfo(name)
-    #    verbose(f"Going to delete {name} ({info['URL']}; {info['StorePath']})")
-    #    to_delete_nars.append(info['URL'])
-    #    size = info['_NarInfoSize'] + info['FileSize']
-    #    for ref in info['References']:
-    #        if ref == name:
-    #            continue
-    #        size += traverse_narinfo(ref)
-
-    #    to_delete.add(name)
-    #    return size
-
-    #i = 0
-    #while free_size < total_size - gc_stop:
-    #    obj = narinfos[i]
-    #    free_size += traverse_narinfo(obj.object_name)
-    #    verbose(f'Up to {free_size/1024/1024}MiB')
-    #    i += 1
-
-    #assert len(to_delete_nars) == len(to_delete)
-    #log(f'About to delete {len(to_delete)} NARs (and associated narinfos), total size {free_size/1024/1024}MiB')
+    delete(to_delete, index)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+# Benchmark nix_cache_gc against an in-process stand-in for the S3 bucket
+import argparse
+import bisect
+import configparser
+import datetime
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+import minio
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import nix_cache_gc
+
+NIX_BASE32 = nix_cache_gc.NIX_BASE32
+EPOCH = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+
+class FakeObject:
+    __slots__ = ('object_name', 'size', 'last_modified', 'etag')
+
+    def __init__(self, name, size, last_modified, etag):
+        self.object_name = name
+        self.size = size
+        self.last_modified = last_modified
+        self.etag = etag
+
+class FakeResponse(io.BytesIO):
+    def release_conn(self):
+        pass
+
+class FakeDeleteError:
+    def __init__(self, name):
+        self.name = name
+        self.code = 'InternalError'
+        self.message = 'injected failure'
+
+class FakeS3:
+    '''
+    The subset of minio.Minio that nix_cache_gc uses, over a single bucket kept in sorted order.
+    narinfo bodies are rendered when fetched rather than stored.
+    '''
+    def __init__(self, latency=0.0, failure_rate=0.0):
+        self.names = []
+        self.objects = {}
+        self.narinfos = {}
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.lock = threading.Lock()
+        self.requests = defaultdict(int)
+
+    def put(self, name, size, last_modified, narinfo=None):
+        self.objects[name] = FakeObject(name, size, last_modified, hashlib.md5(name.encode('utf-8')).hexdigest())
+        if narinfo:
+            self.narinfos[name] = narinfo
+
+    def seal(self):
+        self.names = sorted(self.objects)
+
+    def request(self, kind):
+        self.requests[kind] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def list_objects(self, bucket, prefix=None, recursive=False, start_after=None):
+        i = bisect.bisect_right(self.names, start_after) if start_after else 0
+        while True:
+            # Pages of 1000, like the real thing
+            self.request('list')
+            with self.lock:
+                page = [self.objects[n] for n in self.names[i:i+1000] if n in self.objects]
+                i += 1000
+                end = i >= len(self.names)
+            for obj in page:
+                if prefix is None or obj.object_name.startswith(prefix):
+                    yield obj
+            if end:
+                return
+
+    def get_object(self, bucket, name):
+        self.request('get')
+        with self.lock:
+            if name not in self.objects:
+                raise minio.error.S3Error('NoSuchKey', 'not found', name, None, None, None)
+            store_hash, url, nar_size, refs = self.narinfos[name]
+        body = '\n'.join([
+            f'StorePath: /nix/store/{store_hash}-bench',
+            f'URL: {url}',
+            'Compression: xz',
+            f'FileSize: {nar_size}',
+            f'NarSize: {nar_size * 3}',
+            f'References: {" ".join(f"{r}-bench" for r in refs)}',
+            '',
+        ])
+        return FakeResponse(body.encode('utf-8'))
+
+    def remove_objects(self, bucket, delete_objs):
+        names = [o.name for o in delete_objs]
+        self.request('delete')
+        errors = []
+        with self.lock:
+            for name in names:
+                if self.failure_rate and random.random() < self.failure_rate:
+                    errors.append(FakeDeleteError(name))
+                    continue
+                self.objects.pop(name, None)
+                self.narinfos.pop(name, None)
+        return iter(errors)
+
+    def total_size(self):
+        return sum(o.size for o in self.objects.values())
+
+def fill(s3, objects, args):
+    '''A cache of objects / 2 store paths, each a narinfo and its NAR, referring to older ones'''
+    rng = random.Random(args.seed)
+    paths = objects // 2
+    hashes = []
+    for i in range(paths):
+        h = ''.join(rng.choice(NIX_BASE32) for _ in range(32))
+        uploaded = EPOCH + datetime.timedelta(seconds=i * 60 + rng.randrange(60))
+        refs = {h}
+        if hashes:
+            # Mostly recent dependencies, some long lived ones (toolchains etc.)
+            for _ in range(rng.randrange(args.max_refs + 1)):
+                j = len(hashes) - 1 - min(int(rng.expovariate(1 / 50)), len(hashes) - 1) if rng.random() < 0.8 else rng.randrange(len(hashes))
+                refs.add(hashes[j])
+        nar_size = int(rng.lognormvariate(11, 2)) + 1
+        nar = f'nar/{hashlib.sha256(h.encode("utf-8")).hexdigest()[:52]}.nar.xz'
+        s3.put(nar, nar_size, uploaded)
+        s3.put(f'{h}.narinfo', 400 + 60 * len(refs), uploaded, (h, nar, nar_size, tuple(refs)))
+        hashes.append(h)
+    s3.seal()
+
+class Stats:
+    def __init__(self):
+        self.time = defaultdict(float)
+        self.count = defaultdict(int)
+
+def instrument(stats):
+    def timed(name, f, counter=None):
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            listed = stats.time['list']
+            try:
+                result = f(*args, **kwargs)
+                if counter:
+                    stats.count[name] += counter(args, result)
+                return result
+            finally:
+                # Listing consumed by the planner is accounted separately
+                stats.time[name] += time.perf_counter() - start - (stats.time['list'] - listed)
+        return wrapper
+
+    list_sharded = nix_cache_gc.list_sharded
+    def timed_listing(*args, **kwargs):
+        it = list_sharded(*args, **kwargs)
+        while True:
+            start = time.perf_counter()
+            try:
+                obj = next(it)
+            except StopIteration:
+                return
+            finally:
+                stats.time['list'] += time.perf_counter() - start
+            stats.count['list'] += 1
+            yield obj
+    nix_cache_gc.list_sharded = timed_listing
+
+    Index = nix_cache_gc.Index
+    Index.refresh_narinfos = timed('fetch', Index.refresh_narinfos)
+    Index.closure = timed('plan', Index.closure)
+    Index.oldest = timed('plan', Index.oldest)
+    nix_cache_gc.oldest_objects = timed('plan', nix_cache_gc.oldest_objects)
+    nix_cache_gc.delete_objects = timed('delete', nix_cache_gc.delete_objects, lambda args, failed: len(args[2]) - len(failed))
+
+def rss_mib():
+    with open('/proc/self/status', 'r') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+def run(objects, strategy, dry_run, args, results):
+    '''Runs in a child process, so that each run starts from a fresh heap'''
+    try:
+        bench(objects, strategy, dry_run, args, results)
+    except BaseException as ex:
+        results.put({'error': repr(ex)})
+        raise
+
+def bench(objects, strategy, dry_run, args, results):
+    s3 = FakeS3(args.latency / 1000, args.failure_rate)
+    fill(s3, objects, args)
+    total = s3.total_size()
+    baseline = rss_mib()
+
+    stats = Stats()
+    instrument(stats)
+    minio.Minio = lambda *a, **kw: s3
+    nix_cache_gc.log = lambda message: None
+
+    with tempfile.TemporaryDirectory(prefix='nix-cache-gc-bench-') as tmp:
+        config = configparser.ConfigParser()
+        config['gc'] = {
+            'threshold': str(total * 3 // 4 // 1024 // 1024),
+            'stop': str(total // 2 // 1024 // 1024),
+            'strategy': strategy,
+            'fetch_workers': str(args.workers),
+            'delete_workers': str(args.workers),
+            'list_workers': str(args.workers),
+        }
+        if args.index:
+            config['gc']['index'] = os.path.join(tmp, 'index.sqlite')
+        config['s3'] = {'endpoint': 'bench', 'bucket': 'bench'}
+        config_file = os.path.join(tmp, 'gc.ini')
+        with open(config_file, 'w') as f:
+            config.write(f)
+
+        sys.argv = ['nix_cache_gc', '-c', config_file] + (['--dry-run'] if dry_run else [])
+        start = time.perf_counter()
+        nix_cache_gc.main()
+        elapsed = time.perf_counter() - start
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    results.put({
+        'objects': objects,
+        'strategy': strategy,
+        'mode': 'dry-run' if dry_run else 'real',
+        'total': elapsed,
+        'times': dict(stats.time),
+        'listed': stats.count['list'],
+        'deleted': stats.count['delete'],
+        'requests': dict(s3.requests),
+        'peak_rss_mib': peak - baseline,
+        'remaining_objects': len(s3.objects),
+    })
+
+def report(r):
+    t = r['times']
+    deleted = r['deleted']
+    line = (f"{r['objects']:>9} {r['strategy']:<8} {r['mode']:<8} total {r['total']:>7.2f}s"
+            f"  list {t.get('list', 0):>6.2f}s  fetch {t.get('fetch', 0):>6.2f}s  plan {t.get('plan', 0):>6.2f}s")
+    if deleted:
+        line += f"  delete {deleted} at {deleted / t['delete']:>8.0f}/s"
+    line += f"  peak RSS +{r['peak_rss_mib']:.0f}MiB"
+    print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark nix_cache_gc on a synthetic cache')
+    parser.add_argument('-n', '--objects', type=int, nargs='+', default=[10_000, 100_000, 1_000_000], help='cache sizes (narinfos + NARs)')
+    parser.add_argument('-s', '--strategy', nargs='+', choices=('age', 'closure'), default=['age', 'closure'], help='strategies to run')
+    parser.add_argument('-m', '--mode', nargs='+', choices=('dry-run', 'real'), default=['dry-run', 'real'], help='whether to delete')
+    parser.add_argument('-w', '--workers', type=int, default=8, help='listing / fetching / deleting concurrency')
+    parser.add_argument('--max-refs', type=int, default=8, help='most references per store path')
+    parser.add_argument('--latency', type=float, default=0, help='milliseconds added to every request')
+    parser.add_argument('--failure-rate', type=float, default=0, help='fraction of deletions that fail')
+    parser.add_argument('--index', action='store_true', help='use an on-disk index rather than an in-memory one')
+    parser.add_argument('--seed', type=int, default=1, help='random seed for the synthetic cache')
+    parser.add_argument('--json', metavar='FILE', help='also write results as JSON')
+    args = parser.parse_args()
+
+    ctx = multiprocessing.get_context('fork')
+    results = []
+    for objects in args.objects:
+        for strategy in args.strategy:
+            for mode in args.mode:
+                queue = ctx.Queue()
+                p = ctx.Process(target=run, args=(objects, strategy, mode == 'dry-run', args, queue))
+                p.start()
+                r = queue.get()
+                p.join()
+                if 'error' in r:
+                    print(f'{objects} objects, {strategy}, {mode}: failed with {r["error"]}', file=sys.stderr)
+                    sys.exit(1)
+                report(r)
+                results.append(r)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'args': vars(args), 'results': results}, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,6 @@
 { lib, pkgs, config, ... }:
 let
-  inherit (lib) mkMerge mkIf mkForce genAttrs concatMapStringsSep;
+  inherit (lib) mkMerge mkIf mkForce genAttrs concatMapStringsSep optionalString;
   inherit (lib.my) mkOpt' mkBoolOpt';
 
   cfg = config.my.netboot;
@@ -37,7 +37,6 @@ let
     replacements = {
       inherit (pkgs) python3;
       bootspecTools = pkgs.bootspec;
-      nix = config.nix.package.out;
 
       inherit (config.system.nixos) distroName;
       systemName = config.system.name;
@@ -50,12 +49,22 @@ let
       '';
     };
   };
+
+  netbootServer = pkgs.replaceVarsWith {
+    src = ./netboot-server.py;
+    isExecutable = true;
+    replacements = {
+      inherit (pkgs) python3;
+    };
+  };
 in
 {
   options.my.netboot = with lib.types; {
     client = {
       enable = mkBoolOpt' false "Whether network booting should be enabled.";
       configurationLimit = mkOpt' ints.unsigned 10 "Max generations to show in boot menu.";
+      timings = mkBoolOpt' false "Whether the boot loader installer should print a summary of where its time went.";
+      verifyAt = mkOpt' (nullOr str) null "When to check installed boot files against the store (systemd calendar expression).";
     };
     server = {
       enable = mkBoolOpt' false "Whether a netboot server should be enabled.";
@@ -66,6 +75,11 @@ in
         storeSize = mkOpt' str "16GiB" "Total allowed writable size of store.";
       };
       instances = mkOpt' (listOf str) [ ] "Systems to hold boot files for.";
+      http = {
+        builtin = mkBoolOpt' false "Whether to serve boot files with the built-in server instead of nginx.";
+        listen = mkOpt' (nullOr str) null "Address the built-in server should listen on (all if null).";
+        port = mkOpt' port 80 "Port the built-in server should listen on.";
+      };
     };
   };
 
@@ -102,6 +116,17 @@ in
 
             wantedBy = [ "remote-fs.target" ];
           };
+
+          netboot-verify = mkIf (cfg.client.verifyAt != null) {
+            description = "Verify netboot files";
+            requires = [ "mount-boot.service" ];
+            after = [ "mount-boot.service" ];
+            serviceConfig = {
+              Type = "oneshot";
+              ExecStart = "${bootBuilder} --verify";
+            };
+            startAt = cfg.client.verifyAt;
+          };
         };
       };
 
@@ -111,7 +136,10 @@ in
         systemd-boot.enable = false;
       };
       system = {
-        build.installBootLoader = bootBuilder;
+        build.installBootLoader =
+          if cfg.client.timings
+          then pkgs.writeShellScript "install-netboot" ''exec ${bootBuilder} --timings "$@"''
+          else bootBuilder;
         boot.loader.id = "ipxe-netboot";
       };
     })
@@ -174,6 +202,19 @@ in
             wantedBy = [ "network-online.target" ];
           };
 
+          netboot-http = mkIf cfg.server.http.builtin {
+            description = "Netboot HTTP server";
+            after = [ "network.target" ];
+            serviceConfig = {
+              ExecStart = "${netbootServer} serve --root /srv/netboot --port ${toString cfg.server.http.port}"
+                + optionalString (cfg.server.http.listen != null) " --listen ${cfg.server.http.listen}";
+              DynamicUser = true;
+              AmbientCapabilities = [ "CAP_NET_BIND_SERVICE" ];
+              Restart = "on-failure";
+            };
+            wantedBy = [ "multi-user.target" ];
+          };
+
           nbd-server = {
             serviceConfig = {
               PrivateUsers = mkForce false;
@@ -189,7 +230,7 @@ in
           root = tftpRoot;
         };
 
-        nginx = {
+        nginx = mkIf (!cfg.server.http.builtin) {
           virtualHosts."${cfg.server.host}" = {
             locations."/" = {
               root = "/srv/netboot";
@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+# Benchmark netboot-loader-builder against a synthetic profiles / store / boot tree
+import argparse
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import types
+from collections import defaultdict
+from typing import Callable, Dict
+
+BUILDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'netboot-loader-builder.py')
+
+# Builder functions timed as phases
+PHASES = [
+  'get_generations',
+  'load_bootspecs',
+  'gen_entry',
+  'install_files',
+  'remove_old_files',
+  'write_menu',
+  'save_manifest',
+]
+
+SYNTHESIZE = '''#!/bin/sh
+# Stub for `synthesize --version 1 <toplevel> <out>`
+exec cat "$3/synthesize.json"
+'''
+
+class Stats:
+  def __init__(self):
+    self.time = defaultdict(float)
+    self.calls = defaultdict(int)
+    self.copies = 0
+    self.bytes_copied = 0
+    self.links = 0
+    self.unlinks = 0
+
+def load_builder(root: str, limit: int) -> types.ModuleType:
+  with open(BUILDER, 'r') as f:
+    src = f.read()
+  for k, v in {
+    'python3': sys.prefix,
+    'bootspecTools': f'{root}/bootspec-tools',
+    'distroName': 'NixOS',
+    'systemName': 'bench',
+    'configurationLimit': str(limit),
+    'checkMountpoints': 'true',
+  }.items():
+    src = src.replace(f'@{k}@', v)
+  src = re.sub(r"^BOOT_MOUNT_POINT = .*$", f"BOOT_MOUNT_POINT = '{root}/boot'", src, flags=re.M)
+  src = re.sub(r"^PROFILES_DIR = .*$", f"PROFILES_DIR = '{root}/profiles'", src, flags=re.M)
+
+  builder = types.ModuleType('netboot_loader_builder')
+  builder.__file__ = BUILDER
+  exec(compile(src, BUILDER, 'exec'), builder.__dict__)
+  return builder
+
+def instrument(builder: types.ModuleType, stats: Stats) -> None:
+  def timed(name: str, f: Callable) -> Callable:
+    def wrapper(*args, **kwargs):
+      start = time.perf_counter()
+      try:
+        return f(*args, **kwargs)
+      finally:
+        stats.time[name] += time.perf_counter() - start
+        stats.calls[name] += 1
+    return wrapper
+
+  for name in PHASES:
+    setattr(builder, name, timed(name, getattr(builder, name)))
+
+  copy_file = builder.copy_file
+  def counted_copy(source: str, dest: str, digest: str) -> Dict:
+    record = copy_file(source, dest, digest)
+    stats.copies += 1
+    stats.bytes_copied += record['size']
+    return record
+  builder.copy_file = counted_copy
+
+  link_blob = builder.link_blob
+  def counted_link(*args):
+    stats.links += 1
+    return link_blob(*args)
+  builder.link_blob = counted_link
+
+  remove_old_files = builder.remove_old_files
+  def counted_remove(directory: str, paths: set[str]) -> None:
+    stats.unlinks += len(paths)
+    return remove_old_files(directory, paths)
+  builder.remove_old_files = counted_remove
+
+class Tree:
+  '''Synthetic /nix/store, /nix/var/nix/profiles and /boot.'''
+  def __init__(self, root: str, args: argparse.Namespace):
+    self.root = root
+    self.args = args
+    self.next_gen: Dict[str | None, int] = defaultdict(lambda: 1)
+    for d in ('store', 'profiles/system-profiles', 'boot', 'bootspec-tools/bin'):
+      os.makedirs(f'{root}/{d}')
+
+    synthesize = f'{root}/bootspec-tools/bin/synthesize'
+    with open(synthesize, 'w') as f:
+      f.write(SYNTHESIZE)
+    os.chmod(synthesize, 0o755)
+
+  def artifact(self, name: str, size: int) -> str:
+    path = f'{self.root}/store/{name}'
+    if not os.path.exists(path):
+      os.makedirs(path)
+      with open(f'{path}/data', 'wb') as f:
+        # Unique header so that only intentionally shared artifacts are identical
+        f.write(name.encode('utf-8').ljust(4096, b'\0'))
+        f.truncate(size)
+    return f'{path}/data'
+
+  def bootspec(self, toplevel: str, name: str, gen: int) -> Dict:
+    a = self.args
+    return {
+      'init': f'{toplevel}/init',
+      'initrd': self.artifact(f'{name}-{gen}-initrd', a.initrd_size),
+      # Kernels only change every so often
+      'kernel': self.artifact(f'linux-{gen // a.kernel_reuse}-kernel', a.kernel_size),
+      'kernelParams': ['console=ttyS0', 'quiet'],
+      'label': f'{name} generation {gen}',
+      'system': 'x86_64-linux',
+      'toplevel': toplevel,
+    }
+
+  def add_generation(self, profile: str | None) -> str:
+    a = self.args
+    gen = self.next_gen[profile]
+    self.next_gen[profile] += 1
+    name = profile or 'system'
+    toplevel = f'{self.root}/store/{name}-{gen}-nixos-system'
+
+    specialisations = {}
+    for i in range(a.specialisations):
+      spec_toplevel = f'{toplevel}-spec{i}'
+      os.makedirs(spec_toplevel)
+      specialisations[f'spec{i}'] = {
+        'org.nixos.bootspec.v1': self.bootspec(spec_toplevel, f'{name}-spec{i}', gen),
+        'org.nixos.specialisation.v1': {},
+      }
+    os.makedirs(f'{toplevel}/specialisation')
+    for s in specialisations:
+      os.symlink(f'{toplevel}-{s}', f'{toplevel}/specialisation/{s}')
+
+    bootspec = {
+      'org.nixos.bootspec.v1': self.bootspec(toplevel, name, gen),
+      'org.nixos.specialisation.v1': specialisations,
+    }
+    # Older generations predate bootspec and have to be synthesized
+    with open(f'{toplevel}/{"synthesize.json" if gen <= a.synthesize else "boot.json"}', 'w') as f:
+      json.dump(bootspec, f)
+
+    if profile:
+      link = f'{self.root}/profiles/system-profiles/{profile}'
+    else:
+      link = f'{self.root}/profiles/system'
+    os.symlink(toplevel, f'{link}-{gen}-link')
+    if os.path.lexists(link):
+      os.unlink(link)
+    os.symlink(f'{os.path.basename(link)}-{gen}-link', link)
+    return toplevel
+
+def nix_env_generations(profile: str) -> list[int]:
+  '''Generations of `profile` as `nix-env --list-generations` lists them, emulated when nix-env isn't around.'''
+  if shutil.which('nix-env'):
+    out = subprocess.check_output(['nix-env', '--list-generations', '-p', profile], text=True)
+    return [int(line.split()[0]) for line in out.splitlines() if line.strip()]
+  # Links next to the profile named `<profile>-<number>-link`, in numeric order
+  directory, name = os.path.split(profile)
+  gens = []
+  for e in os.listdir(directory):
+    n = e[len(name) + 1:-len('-link')]
+    if e.startswith(f'{name}-') and e.endswith('-link') and n.isdigit():
+      gens.append(int(n))
+  return sorted(gens)
+
+def check_generations(args: argparse.Namespace) -> bool:
+  '''
+  Compare get_generations with the nix-env based enumeration it replaced, on a tree with deleted
+  generations, generations past 9 and profile names that themselves end in `-<number>`.
+  '''
+  root = tempfile.mkdtemp(prefix='netboot-check-')
+  try:
+    tree = Tree(root, args)
+    for profile in (None, 'foo', 'foo-1', 'foo-1-2', 'bar'):
+      for _ in range(12):
+        tree.add_generation(profile)
+    os.unlink(f'{root}/profiles/system-3-link')
+    os.unlink(f'{root}/profiles/system-profiles/foo-10-link')
+    os.unlink(f'{root}/profiles/system-profiles/foo-1-2-1-link')
+    # Other profiles next to the system one aren't booted
+    os.symlink('/nonexistent', f'{root}/profiles/default-1-link')
+    os.symlink('default-1-link', f'{root}/profiles/default')
+
+    ok = True
+    limits = [0, 1, 5, 100]
+    for limit in limits:
+      builder = load_builder(root, limit)
+      got = builder.get_generations(builder.Target())
+
+      # What the builder used to do: nix-env for the system profile, then every system-profiles entry
+      # that isn't a generation link, keeping the last `limit` generations of each
+      expected = []
+      profiles = [p for p in os.listdir(f'{root}/profiles/system-profiles') if not p.endswith('-link')]
+      for profile in [None] + sorted(profiles):
+        path = f'{root}/profiles/system-profiles/{profile}' if profile else f'{root}/profiles/system'
+        expected += [builder.SystemIdentifier(profile, g, None) for g in nix_env_generations(path)[-limit:]]
+
+      if got != expected:
+        ok = False
+        print(f'configuration limit {limit}: get_generations differs from nix-env', file=sys.stderr)
+        print(f'  got:      {got}', file=sys.stderr)
+        print(f'  expected: {expected}', file=sys.stderr)
+    if ok:
+      source = 'nix-env' if shutil.which('nix-env') else 'emulated nix-env'
+      print(f'get_generations matches {source} for configuration limits {", ".join(map(str, limits))}')
+    return ok
+  finally:
+    shutil.rmtree(root)
+
+def run(builder: types.ModuleType, stats: Stats, default: str) -> float:
+  # Clear per-process state, as every real run is a new process
+  builder.bootspecs.clear()
+  builder.cached_bootspecs.clear()
+  builder.used_toplevels.clear()
+
+  start = time.perf_counter()
+  builder.install_single(argparse.Namespace(default_config=default))
+  return time.perf_counter() - start
+
+def report(scenario: str, total: float, stats: Stats) -> Dict:
+  print(f'{scenario}: {total*1000:.1f}ms')
+  for name in PHASES:
+    if stats.calls[name]:
+      print(f'  {name:<18} {stats.time[name]*1000:>10.1f}ms {stats.calls[name]:>6} calls')
+  print(f'  {stats.copies} copies ({stats.bytes_copied/1024/1024:.1f}MiB), {stats.links} links, {stats.unlinks} unlinks')
+  return {
+    'total': total,
+    'phases': {n: {'time': stats.time[n], 'calls': stats.calls[n]} for n in PHASES},
+    'copies': stats.copies,
+    'bytes_copied': stats.bytes_copied,
+    'links': stats.links,
+    'unlinks': stats.unlinks,
+  }
+
+def main() -> None:
+  parser = argparse.ArgumentParser(description='Benchmark netboot-loader-builder on a synthetic generation history')
+  parser.add_argument('-g', '--generations', type=int, default=100, help='generations of the system profile')
+  parser.add_argument('-p', '--profiles', type=int, default=2, help='number of extra system profiles')
+  parser.add_argument('--profile-generations', type=int, default=20, help='generations of each extra profile')
+  parser.add_argument('-s', '--specialisations', type=int, default=1, help='specialisations per generation')
+  parser.add_argument('-l', '--limit', type=int, default=0, help='configuration limit (0 for all generations)')
+  parser.add_argument('--kernel-size', type=int, default=8*1024*1024, help='size of each kernel in bytes')
+  parser.add_argument('--initrd-size', type=int, default=16*1024*1024, help='size of each initrd in bytes')
+  parser.add_argument('--kernel-reuse', type=int, default=10, help='generations sharing each kernel')
+  parser.add_argument('--synthesize', type=int, default=0, help='number of oldest generations without boot.json')
+  parser.add_argument('--json', metavar='FILE', help='also write results as JSON')
+  parser.add_argument('--keep', action='store_true', help="don't delete the temporary tree")
+  parser.add_argument('--check', action='store_true', help='check get_generations against nix-env instead of benchmarking')
+  args = parser.parse_args()
+
+  if args.check:
+    sys.exit(0 if check_generations(args) else 1)
+
+  root = tempfile.mkdtemp(prefix='netboot-bench-')
+  try:
+    tree = Tree(root, args)
+    for _ in range(args.generations):
+      tree.add_generation(None)
+    for p in range(args.profiles):
+      for _ in range(args.profile_generations):
+        tree.add_generation(f'profile{p}')
+
+    builder = load_builder(root, args.limit)
+    results = {}
+    scenarios: list[tuple[str, Callable[[], None]]] = [
+      ('initial', lambda: None),
+      ('unchanged', lambda: None),
+      ('new-generation', lambda: tree.add_generation(None)),
+    ]
+    for scenario, prepare in scenarios:
+      prepare()
+      stats = Stats()
+      instrument(builder, stats)
+      total = run(builder, stats, f'{root}/profiles/system')
+      results[scenario] = report(scenario, total, stats)
+      builder = load_builder(root, args.limit)
+
+    if args.json:
+      with open(args.json, 'w') as f:
+        json.dump({'args': vars(args), 'results': results}, f, indent=2)
+  finally:
+    if args.keep:
+      print(f'Tree left in {root}', file=sys.stderr)
+    else:
+      shutil.rmtree(root)
+
+if __name__ == '__main__':
+  main()
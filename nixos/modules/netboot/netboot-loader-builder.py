@@ -2,27 +2,118 @@
 # Based on `nixos/modules/system/boot/loader/systemd-boot/systemd-boot-builder.py`
 import argparse
 import datetime
-import glob
+import errno
+import fcntl
+import hashlib
+import heapq
 import os
 import os.path
-import shutil
+import re
 import subprocess
 import sys
 import json
-from typing import NamedTuple, Dict, List
-from dataclasses import dataclass
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from collections import defaultdict
+from typing import NamedTuple, Dict, Iterator, List
+from dataclasses import dataclass, asdict
 
 BOOT_MOUNT_POINT = '/boot'
 STORE_DIR = 'nix'
+PROFILES_DIR = '/nix/var/nix/profiles'
+BOOTSPEC_CACHE = 'bootspecs.json'
+BOOTSPEC_CACHE_VERSION = 1
+MANIFEST = 'manifest.json'
+MANIFEST_VERSION = 2
+BLOB_DIR = '.blobs'
+VERIFY_INDEX = 'verify-index.json'
+HASH_CHUNK = 1024 * 1024
+# From linux/fs.h
+FICLONE = 0x40049409
+MAX_WORKERS = min(32, (os.cpu_count() or 1) + 4)
 
 # These values will be replaced with actual values during the package build
 BOOTSPEC_TOOLS = '@bootspecTools@'
-NIX = '@nix@'
 DISTRO_NAME = '@distroName@'
 SYSTEM_NAME = '@systemName@'
 CONFIGURATION_LIMIT = int('@configurationLimit@')
 CHECK_MOUNTPOINTS = "@checkMountpoints@"
 
+class Tracer:
+  '''Records timed events (subprocesses, bootspec loads, copies, unlinks...) when enabled.'''
+  def __init__(self):
+    self.enabled = False
+    self.events: list[Dict] = []
+    self.lock = threading.Lock()
+    self.start = time.monotonic()
+
+  @contextmanager
+  def span(self, cat: str, name: str, **args) -> Iterator[Dict]:
+    # `args` is yielded so details only known afterwards (e.g. sizes) can be added
+    if not self.enabled:
+      yield args
+      return
+    start = time.monotonic()
+    try:
+      yield args
+    finally:
+      end = time.monotonic()
+      with self.lock:
+        self.events.append({
+          'cat': cat,
+          'name': name,
+          'start': start - self.start,
+          'duration': end - start,
+          'thread': threading.get_ident(),
+          'args': args,
+        })
+
+  def write_json(self, path: str) -> None:
+    with open(path, 'w') as f:
+      json.dump({'events': self.events}, f)
+
+  def write_chrome_trace(self, path: str) -> None:
+    # https://docs.google.com/document/d/1CvAClvFfyA5R-PhYUmn5OOQtYMH4h6I0nSsKchNAySU
+    pid = os.getpid()
+    with open(path, 'w') as f:
+      json.dump({'traceEvents': [{
+        'name': e['name'],
+        'cat': e['cat'],
+        'ph': 'X',
+        'ts': e['start'] * 1e6,
+        'dur': e['duration'] * 1e6,
+        'pid': pid,
+        'tid': e['thread'],
+        'args': e['args'],
+      } for e in self.events]}, f)
+
+  def print_summary(self) -> None:
+    total = time.monotonic() - self.start
+    print(f'netboot builder timings ({total*1000:.1f}ms total):', file=sys.stderr)
+    print(f'  {"event":<30} {"count":>6} {"time":>10} {"bytes":>10}', file=sys.stderr)
+
+    rows = defaultdict(lambda: [0, 0.0, 0])
+    for e in self.events:
+      if e['cat'] == 'phase':
+        key = f'phase {e["name"]}'
+      elif e['cat'] == 'bootspec':
+        key = f'bootspec {e["args"]["cache"]}'
+      elif e['cat'] == 'subprocess':
+        key = f'subprocess {e["name"]}'
+      else:
+        key = e['cat']
+      row = rows[key]
+      row[0] += 1
+      row[1] += e['duration']
+      row[2] += e['args'].get('bytes', 0)
+    for key, (count, duration, size) in rows.items():
+      size = f'{size/1024/1024:.1f}MiB' if size else ''
+      print(f'  {key:<30} {count:>6} {duration*1000:>8.1f}ms {size:>10}', file=sys.stderr)
+
+trace = Tracer()
+
 @dataclass
 class BootSpec:
   init: str
@@ -41,18 +132,130 @@ class SystemIdentifier(NamedTuple):
   generation: int
   specialisation: str | None
 
-def copy_if_not_exists(source: str, dest: str) -> None:
-  if not os.path.exists(dest):
-    shutil.copyfile(source, dest)
-
-def generation_dir(profile: str | None, generation: int) -> str:
+@dataclass
+class Target:
+  '''A system to install boot files and a menu for.'''
+  boot_dir: str = BOOT_MOUNT_POINT
+  system_name: str = SYSTEM_NAME
+  distro_name: str = DISTRO_NAME
+  profiles_dir: str = PROFILES_DIR
+  configuration_limit: int = CONFIGURATION_LIMIT
+  # Content-addressed store for boot files, may be shared between targets on the same filesystem
+  blob_dir: str = ''
+
+  def __post_init__(self):
+    if not self.blob_dir:
+      self.blob_dir = f'{self.boot_dir}/{STORE_DIR}/{BLOB_DIR}'
+
+def copy_range(src: int, dst: int, offset: int, count: int) -> None:
+  # Prefer in-kernel copies, falling back as the filesystems involved allow
+  global copy_method
+  while count > 0:
+    try:
+      if copy_method == 'copy_file_range':
+        n = os.copy_file_range(src, dst, count, offset, offset)
+      elif copy_method == 'sendfile':
+        os.lseek(dst, offset, os.SEEK_SET)
+        n = os.sendfile(dst, src, offset, count)
+      else:
+        n = os.pwrite(dst, os.pread(src, count, offset), offset)
+    except OSError as ex:
+      if ex.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP) or copy_method == 'pwrite':
+        raise
+      copy_method = 'sendfile' if copy_method == 'copy_file_range' else 'pwrite'
+      continue
+    if n == 0:
+      raise OSError(errno.EIO, 'Unexpected end of file while copying')
+    offset += n
+    count -= n
+copy_method = 'copy_file_range'
+
+def copy_file(source: str, dest: str, digest: str) -> Dict:
+  '''
+  Copy `source`, whose sha256 is `digest`, to `dest` via a temporary file. The data never passes
+  through userspace on the way; the copy is read back and hashed before it replaces `dest`, so
+  neither a crash mid-copy nor a corrupted copy can ever leave a bad `dest` behind.
+  '''
+  tmp = f'{dest}.tmp'
+  with open(source, 'rb') as src, open(tmp, 'wb') as dst, trace.span('copy', dest, source=source) as span:
+    size = os.fstat(src.fileno()).st_size
+    span['bytes'] = size
+    try:
+      fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+      span['method'] = 'reflink'
+    except OSError:
+      span['method'] = copy_method
+      copy_range(src.fileno(), dst.fileno(), 0, size)
+    os.fsync(dst.fileno())
+
+  copied = hash_file(tmp)
+  if copied != digest:
+    os.unlink(tmp)
+    raise OSError(errno.EIO, f'Copy of {source} to {dest} has hash {copied} instead of {digest}')
+  os.rename(tmp, dest)
+  return {'source': source, 'size': size, 'hash': copied}
+
+blob_locks: Dict[str, threading.Lock] = {}
+blob_locks_lock = threading.Lock()
+def blob_lock(blob: str) -> threading.Lock:
+  # Targets sharing a blob store may try to install the same blob at once
+  with blob_locks_lock:
+    return blob_locks.setdefault(blob, threading.Lock())
+
+def install_blob(t: Target, record: Dict, dest: str) -> None:
+  blob = f'{t.blob_dir}/{record["hash"]}'
+  with blob_lock(blob):
+    if os.path.isfile(blob):
+      return
+
+    # A plain copy from before the blob store existed can be adopted as-is
+    if os.path.isfile(dest) and not os.path.islink(dest) and os.path.getsize(dest) == record['size'] \
+        and hash_file(dest) == record['hash']:
+      os.link(dest, blob)
+      return
+
+    copy_file(record['source'], blob, record['hash'])
+
+def link_blob(t: Target, digest: str, dest: str) -> None:
+  blob = f'{t.blob_dir}/{digest}'
+  # Renaming over another link to the same inode is a no-op, so don't try
+  if os.path.exists(dest) and os.path.samefile(blob, dest):
+    return
+
+  tmp = f'{dest}.tmp'
+  try:
+    os.unlink(tmp)
+  except FileNotFoundError:
+    pass
+  try:
+    os.link(blob, tmp)
+  except OSError as ex:
+    if ex.errno not in (errno.EPERM, errno.EXDEV, errno.EMLINK, errno.EOPNOTSUPP):
+      raise
+    os.symlink(os.path.relpath(blob, os.path.dirname(dest)), tmp)
+  os.rename(tmp, dest)
+
+def hash_file(path: str) -> str:
+  h = hashlib.sha256()
+  with open(path, 'rb') as f, trace.span('hash', path) as span:
+    while chunk := f.read(HASH_CHUNK):
+      h.update(chunk)
+    span['bytes'] = f.tell()
+  return h.hexdigest()
+
+def write_json(path: str, data: Dict) -> None:
+  with open(f'{path}.tmp', 'w') as f:
+    json.dump(data, f)
+  os.rename(f'{path}.tmp', path)
+
+def generation_dir(t: Target, profile: str | None, generation: int) -> str:
   if profile:
-    return f'/nix/var/nix/profiles/system-profiles/{profile}-{generation}-link'
+    return f'{t.profiles_dir}/system-profiles/{profile}-{generation}-link'
   else:
-    return f'/nix/var/nix/profiles/system-{generation}-link'
+    return f'{t.profiles_dir}/system-{generation}-link'
 
-def system_dir(i: SystemIdentifier) -> str:
-  d = generation_dir(i.profile, i.generation)
+def system_dir(t: Target, i: SystemIdentifier) -> str:
+  d = generation_dir(t, i.profile, i.generation)
   if i.specialisation:
     return os.path.join(d, 'specialisation', i.specialisation)
   else:
@@ -79,39 +282,84 @@ def bootspec_from_json(bootspec_json: Dict) -> BootSpec:
     sortKey=sortKey
   )
 
+def bootspec_from_cache(d: Dict) -> BootSpec:
+  return BootSpec(**{
+    **d,
+    'specialisations': {k: bootspec_from_cache(v) for k, v in d['specialisations'].items()},
+  })
+
+# Parsed bootspecs keyed by toplevel store path, persisted across runs (store paths are immutable)
+cached_bootspecs: Dict[str, BootSpec] = {}
+used_toplevels: set[str] = set()
+def load_bootspec_cache(cache_file: str) -> None:
+  try:
+    with open(cache_file, 'r') as f:
+      cache = json.load(f)
+  except (OSError, ValueError):
+    return
+  if cache.get('version') != BOOTSPEC_CACHE_VERSION:
+    return
+  for toplevel, d in cache['bootspecs'].items():
+    cached_bootspecs[toplevel] = bootspec_from_cache(d)
+
+def save_bootspec_cache(cache_file: str) -> None:
+  # Only keep entries for generations that still exist
+  cache = {
+    'version': BOOTSPEC_CACHE_VERSION,
+    'bootspecs': {t: asdict(cached_bootspecs[t]) for t in sorted(used_toplevels)},
+  }
+  write_json(cache_file, cache)
+
 bootspecs = {}
-def get_bootspec(profile: str | None, generation: int) -> BootSpec:
-  k = (profile, generation)
+def get_bootspec(t: Target, profile: str | None, generation: int) -> BootSpec:
+  system_directory = system_dir(t, SystemIdentifier(profile, generation, None))
+  k = system_directory
   if k in bootspecs:
     return bootspecs[k]
 
-  system_directory = system_dir(SystemIdentifier(profile, generation, None))
-  boot_json_path = os.path.realpath(f'{system_directory}/boot.json')
-  if os.path.isfile(boot_json_path):
-    boot_json_f = open(boot_json_path, 'r')
-    bootspec_json = json.load(boot_json_f)
-  else:
-    boot_json_str = subprocess.check_output([
-      f'{BOOTSPEC_TOOLS}/bin/synthesize',
-      '--version',
-      '1',
-      system_directory,
-      '/dev/stdout',
-    ],
-    universal_newlines=True)
-    bootspec_json = json.loads(boot_json_str)
-
-  bs = bootspec_from_json(bootspec_json)
+  toplevel = os.path.realpath(system_directory)
+  used_toplevels.add(toplevel)
+  if toplevel in cached_bootspecs:
+    with trace.span('bootspec', toplevel, cache='hit'):
+      bs = cached_bootspecs[toplevel]
+    bootspecs[k] = bs
+    return bs
+
+  with trace.span('bootspec', toplevel, cache='miss'):
+    boot_json_path = os.path.realpath(f'{system_directory}/boot.json')
+    if os.path.isfile(boot_json_path):
+      boot_json_f = open(boot_json_path, 'r')
+      bootspec_json = json.load(boot_json_f)
+    else:
+      with trace.span('subprocess', 'synthesize', toplevel=toplevel):
+        boot_json_str = subprocess.check_output([
+          f'{BOOTSPEC_TOOLS}/bin/synthesize',
+          '--version',
+          '1',
+          system_directory,
+          '/dev/stdout',
+        ],
+        universal_newlines=True)
+      bootspec_json = json.loads(boot_json_str)
+
+    bs = bootspec_from_json(bootspec_json)
+  cached_bootspecs[toplevel] = bs
   bootspecs[k] = bs
   return bs
 
-def copy_from_file(file: str, dry_run: bool = False) -> str:
+def load_bootspecs(t: Target, gens: list[SystemIdentifier]) -> None:
+  # Loading is dominated by I/O and `synthesize` subprocesses, so threads are fine
+  with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+    for _ in executor.map(lambda g: get_bootspec(t, g.profile, g.generation), gens):
+      pass
+
+def copy_from_file(t: Target, file: str, dry_run: bool = False) -> str:
   store_file_path = os.path.realpath(file)
   suffix = os.path.basename(store_file_path)
   store_dir = os.path.basename(os.path.dirname(store_file_path))
   dst_path = f'/{STORE_DIR}/{store_dir}-{suffix}'
   if not dry_run:
-    copy_if_not_exists(store_file_path, f'{BOOT_MOUNT_POINT}{dst_path}')
+    install_files(t, {dst_path: store_file_path})
   return dst_path
 
 MENU_ITEM = 'item {gen_key} {title} Generation {generation} {description}'
@@ -122,77 +370,153 @@ initrd ${{server}}/systems/{system_name}{initrd}
 boot
 '''
 
-def gen_entry(i: SystemIdentifier) -> (str, str):
-  bootspec = get_bootspec(i.profile, i.generation)
+def gen_entry(t: Target, i: SystemIdentifier) -> Dict:
+  bootspec = get_bootspec(t, i.profile, i.generation)
   if i.specialisation:
     bootspec = bootspec.specialisations[i.specialisation]
-  kernel = copy_from_file(bootspec.kernel)
-  initrd = copy_from_file(bootspec.initrd)
+  kernel = copy_from_file(t, bootspec.kernel, True)
+  initrd = copy_from_file(t, bootspec.initrd, True)
 
   gen_key = entry_key(i)
   title = '{name}{profile}{specialisation}'.format(
-    name=DISTRO_NAME,
+    name=t.distro_name,
     profile=' [' + i.profile + ']' if i.profile else '',
     specialisation=f' ({i.specialisation})' if i.specialisation else '')
 
   kernel_params = f'init={bootspec.init} '
 
   kernel_params = kernel_params + ' '.join(bootspec.kernelParams)
-  build_time = int(os.path.getctime(system_dir(i)))
+  build_time = int(os.path.getctime(system_dir(t, i)))
   build_date = datetime.datetime.fromtimestamp(build_time).strftime('%F')
 
-  return MENU_ITEM.format(
-    gen_key=gen_key,
-    title=title,
-    description=f'{bootspec.label}, built on {build_date}',
-    generation=i.generation,
-  ), BOOT_ENTRY.format(
-    gen_key=gen_key,
-    generation=i.generation,
-    system_name=SYSTEM_NAME,
-    kernel=kernel,
-    kernel_params=kernel_params,
-    initrd=initrd,
-  )
-
-def get_generations(profile: str | None = None) -> list[SystemIdentifier]:
-  gen_list = subprocess.check_output([
-    f'{NIX}/bin/nix-env',
-    '--list-generations',
-    '-p',
-    '/nix/var/nix/profiles/' + ('system-profiles/' + profile if profile else 'system')],
-    universal_newlines=True)
-  gen_lines = gen_list.split('\n')
-  gen_lines.pop()
-
-  configurationLimit = CONFIGURATION_LIMIT
-  configurations = [
-    SystemIdentifier(
-      profile=profile,
-      generation=int(line.split()[0]),
-      specialisation=None
-    )
-    for line in gen_lines
+  return {
+    'toplevel': os.path.realpath(system_dir(t, i)),
+    'files': {
+      kernel: os.path.realpath(bootspec.kernel),
+      initrd: os.path.realpath(bootspec.initrd),
+    },
+    'item': MENU_ITEM.format(
+      gen_key=gen_key,
+      title=title,
+      description=f'{bootspec.label}, built on {build_date}',
+      generation=i.generation,
+    ),
+    'boot': BOOT_ENTRY.format(
+      gen_key=gen_key,
+      generation=i.generation,
+      system_name=t.system_name,
+      kernel=kernel,
+      kernel_params=kernel_params,
+      initrd=initrd,
+    ),
+  }
+
+re_generation_link = re.compile(r'^(.+)-(\d+)-link$')
+
+def scan_profiles(directory: str) -> tuple[set[str], Dict[str, list[int]]]:
+  '''
+  List the profiles in `directory` and their generations, as `nix-env --list-generations` would find them.
+  '''
+  profiles = set()
+  generations = {}
+  if not os.path.isdir(directory):
+    return profiles, generations
+
+  with os.scandir(directory) as it:
+    for e in it:
+      m = re_generation_link.match(e.name)
+      if m:
+        generations.setdefault(m.group(1), []).append(int(m.group(2)))
+      elif not e.name.endswith('-link'):
+        profiles.add(e.name)
+  return profiles, generations
+
+def profile_generations(t: Target, profile: str | None, generations: list[int]) -> list[SystemIdentifier]:
+  if t.configuration_limit:
+    generations = heapq.nlargest(t.configuration_limit, generations)
+  return [
+    SystemIdentifier(profile=profile, generation=g, specialisation=None)
+    for g in sorted(generations)
   ]
-  return configurations[-configurationLimit:]
-
-def remove_old_files(gens: list[SystemIdentifier]) -> None:
-  known_paths = []
-  for gen in gens:
-    bootspec = get_bootspec(gen.profile, gen.generation)
-    known_paths.append(copy_from_file(bootspec.kernel, True))
-    known_paths.append(copy_from_file(bootspec.initrd, True))
-  for path in glob.iglob(f'{BOOT_MOUNT_POINT}/{STORE_DIR}/*'):
-    if not path in known_paths and not os.path.isdir(path):
-      os.unlink(path)
-
-def get_profiles() -> list[str]:
-  if os.path.isdir('/nix/var/nix/profiles/system-profiles/'):
-    return [x
-      for x in os.listdir('/nix/var/nix/profiles/system-profiles/')
-      if not x.endswith('-link')]
-  else:
-    return []
+
+def get_generations(t: Target) -> list[SystemIdentifier]:
+  _, generations = scan_profiles(t.profiles_dir)
+  gens = profile_generations(t, None, generations.get('system', []))
+
+  profiles, generations = scan_profiles(f'{t.profiles_dir}/system-profiles')
+  for profile in sorted(profiles):
+    gens += profile_generations(t, profile, generations.get(profile, []))
+  return gens
+
+def load_manifest(t: Target) -> Dict | None:
+  try:
+    with open(f'{t.boot_dir}/{MANIFEST}', 'r') as f:
+      manifest = json.load(f)
+  except (OSError, ValueError):
+    return None
+  if manifest.get('version') != MANIFEST_VERSION:
+    return None
+  if manifest['system'] != t.system_name or manifest['distro'] != t.distro_name:
+    # Rendered entries are specific to the system, installed files are not
+    manifest['entries'] = {}
+  return manifest
+
+def save_manifest(t: Target, files: Dict[str, Dict], entries: Dict[str, Dict]) -> None:
+  write_json(f'{t.boot_dir}/{MANIFEST}', {
+    'version': MANIFEST_VERSION,
+    'system': t.system_name,
+    'distro': t.distro_name,
+    'files': files,
+    'entries': entries,
+  })
+
+def installed_files(t: Target, manifest: Dict | None) -> set[str]:
+  if manifest is not None:
+    return set(manifest['files'])
+
+  # No manifest (first run or format change), fall back to scanning
+  with os.scandir(f'{t.boot_dir}/{STORE_DIR}') as it:
+    return {f'/{STORE_DIR}/{e.name}' for e in it if not e.is_dir()}
+
+def installed_blobs(t: Target, manifest: Dict | None) -> set[str]:
+  if manifest is not None:
+    return {f['hash'] for f in manifest['files'].values()}
+
+  with os.scandir(t.blob_dir) as it:
+    return {e.name for e in it if not e.is_dir() and not e.name.endswith('.tmp')}
+
+def install_files(t: Target, sources: Dict[str, str]) -> Dict[str, Dict]:
+  '''
+  Install store files under their per-store-path names, which are links into a content-addressed blob store.
+  Identical files from different store paths are only stored once.
+  '''
+  def record(source: str) -> Dict:
+    return {'source': source, 'size': os.path.getsize(source), 'hash': hash_file(source)}
+
+  with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+    records = dict(zip(sources, executor.map(record, sources.values())))
+    blobs = {r['hash']: p for p, r in records.items()}
+    for _ in executor.map(lambda p: install_blob(t, records[p], f'{t.boot_dir}{p}'), blobs.values()):
+      pass
+
+  for p, r in records.items():
+    link_blob(t, r['hash'], f'{t.boot_dir}{p}')
+  return records
+
+def dedup_report(files: list[Dict]) -> None:
+  total = sum(f['size'] for f in files)
+  stored = sum({f['hash']: f['size'] for f in files}.values())
+  if stored < total:
+    print(f'{len(files)} boot files ({total/1024/1024:.1f}MiB) deduplicated to {stored/1024/1024:.1f}MiB, '
+          f'saving {(total - stored)/1024/1024:.1f}MiB')
+
+def remove_old_files(directory: str, paths: set[str]) -> None:
+  for path in paths:
+    try:
+      with trace.span('unlink', f'{directory}{path}'):
+        os.unlink(f'{directory}{path}')
+    except FileNotFoundError:
+      pass
 
 MENU = '''#!ipxe
 # Server hostname option
@@ -221,23 +545,23 @@ goto start
 chain ${{server}}/boot.ipxe || goto error
 '''
 
-def write_menu(gens: list[SystemIdentifier], default: SystemIdentifier) -> None:
-  gen_menu_items = []
-  gen_cmds = []
-
+def menu_entries(t: Target, gens: list[SystemIdentifier]) -> list[SystemIdentifier]:
+  entries = []
   for g in gens:
-    bootspec = get_bootspec(g.profile, g.generation)
+    bootspec = get_bootspec(t, g.profile, g.generation)
     specialisations = [
       SystemIdentifier(profile=g.profile, generation=g.generation, specialisation=s) for s in bootspec.specialisations]
-    for i in [g] + specialisations:
-      mi, cmds = gen_entry(i)
-      gen_menu_items.append(mi)
-      gen_cmds.append(cmds)
+    entries += [g] + specialisations
+  return entries
 
-  menu_file = f'{BOOT_MOUNT_POINT}/menu.ipxe'
+def write_menu(t: Target, entries: list[Dict], default: SystemIdentifier) -> None:
+  gen_menu_items = [e['item'] for e in entries]
+  gen_cmds = [e['boot'] for e in entries]
+
+  menu_file = f'{t.boot_dir}/menu.ipxe'
   with open(f'{menu_file}.tmp', 'w') as f:
     f.write(MENU.format(
-      distro=DISTRO_NAME,
+      distro=t.distro_name,
       generation_items='\n'.join(gen_menu_items),
       menu_default=entry_key(default),
     ))
@@ -247,34 +571,259 @@ def write_menu(gens: list[SystemIdentifier], default: SystemIdentifier) -> None:
 
   os.rename(f'{menu_file}.tmp', menu_file)
 
-def install_bootloader(args: argparse.Namespace) -> None:
-  os.makedirs(f'{BOOT_MOUNT_POINT}/{STORE_DIR}', exist_ok=True)
+CHOOSER_MENU = '''#!ipxe
+# Server hostname option
+set boothost ${{66:string}}
+set server http://${{boothost}}
+
+:start
+menu Netboot systems
+item --gap -- Systems
+{system_items}
+item --gap -- Other
+item --key m main Main netboot menu
+choose --timeout 5000 --default {menu_default} selected || goto cancel
+goto ${{selected}}
+
+:cancel
+shell
+goto start
 
-  gens = get_generations()
-  for profile in get_profiles():
-    gens += get_generations(profile)
+:error
+echo Booting failed, dropping to shell
+shell
+goto start
 
-  gens = sorted(gens, key=lambda g: entry_key(g), reverse=True)
+:main
+chain ${{server}}/boot.ipxe || goto error
+'''
 
-  remove_old_files(gens)
+CHOOSER_ENTRY = ''':system-{system_name}
+chain ${{server}}/systems/{system_name}/menu.ipxe || goto error
+'''
+
+def write_chooser_menu(output: str, targets: list[Target]) -> None:
+  menu_file = f'{output}/menu.ipxe'
+  with open(f'{menu_file}.tmp', 'w') as f:
+    f.write(CHOOSER_MENU.format(
+      system_items='\n'.join(f'item system-{t.system_name} {t.system_name} ({t.distro_name})' for t in targets),
+      menu_default=f'system-{targets[0].system_name}',
+    ))
+
+    print(file=f)
+    print('\n'.join(CHOOSER_ENTRY.format(system_name=t.system_name) for t in targets), file=f)
+
+  os.rename(f'{menu_file}.tmp', menu_file)
+
+def install_bootloader(t: Target, default_config: str) -> tuple[set[str], set[str], list[Dict]]:
+  '''
+  Install the boot files and menu for `t`.
+  Returns the blobs that were in use before and after, and the records of the installed files.
+  '''
+  os.makedirs(f'{t.boot_dir}/{STORE_DIR}', exist_ok=True)
+  os.makedirs(t.blob_dir, exist_ok=True)
+
+  with trace.span('phase', 'generations', system=t.system_name):
+    gens = sorted(get_generations(t), key=lambda g: entry_key(g), reverse=True)
+  with trace.span('phase', 'bootspecs', system=t.system_name):
+    load_bootspecs(t, gens)
+
+  manifest = load_manifest(t)
+  old_files = manifest['files'] if manifest else {}
+  old_entries = manifest['entries'] if manifest else {}
+
+  # Only render entries whose system changed since the last run
+  entries = {}
+  with trace.span('phase', 'entries', system=t.system_name):
+    for i in menu_entries(t, gens):
+      key = entry_key(i)
+      old = old_entries.get(key)
+      if old and old['toplevel'] == os.path.realpath(system_dir(t, i)):
+        entries[key] = old
+      else:
+        entries[key] = gen_entry(t, i)
+
+  wanted = {dst: src for e in entries.values() for dst, src in e['files'].items()}
+  with trace.span('phase', 'remove', system=t.system_name):
+    remove_old_files(t.boot_dir, installed_files(t, manifest) - wanted.keys())
+
+  files = {p: old_files[p] for p in wanted if p in old_files}
+  with trace.span('phase', 'install', system=t.system_name):
+    files.update(install_files(t, {p: src for p, src in wanted.items() if p not in files}))
 
   for g in gens:
-    if os.path.dirname(get_bootspec(g.profile, g.generation).init) == os.path.realpath(args.default_config):
+    if os.path.dirname(get_bootspec(t, g.profile, g.generation).init) == os.path.realpath(default_config):
       default = g
       break
   else:
     assert False, 'No default generation found'
 
-  write_menu(gens, default)
+  with trace.span('phase', 'menu', system=t.system_name):
+    write_menu(t, list(entries.values()), default)
+    save_manifest(t, files, entries)
+  return installed_blobs(t, manifest), {f['hash'] for f in files.values()}, list(files.values())
+
+def remove_old_blobs(blob_dir: str, old: set[str], in_use: set[str]) -> None:
+  # A blob is freed once no installed file refers to it any more
+  remove_old_files(blob_dir, {f'/{b}' for b in old - in_use})
+
+def install_single(args: argparse.Namespace) -> None:
+  with trace.span('subprocess', 'check-mountpoints'):
+    subprocess.check_call(CHECK_MOUNTPOINTS)
+
+  t = Target()
+  cache_file = f'{t.boot_dir}/{BOOTSPEC_CACHE}'
+  load_bootspec_cache(cache_file)
+  old, in_use, files = install_bootloader(t, args.default_config)
+  save_bootspec_cache(cache_file)
+
+  remove_old_blobs(t.blob_dir, old, in_use)
+  dedup_report(files)
+
+def multi_targets(args: argparse.Namespace) -> tuple[list[Target], list[str]]:
+  with open(args.systems, 'r') as f:
+    systems = json.load(f)
+
+  blob_dir = f'{args.output}/{BLOB_DIR}'
+  targets = [
+    Target(
+      boot_dir=f'{args.output}/{name}',
+      system_name=name,
+      distro_name=s.get('distro', DISTRO_NAME),
+      profiles_dir=s['profiles'],
+      configuration_limit=s.get('configurationLimit', CONFIGURATION_LIMIT),
+      blob_dir=blob_dir,
+    )
+    for name, s in systems.items()
+  ]
+  defaults = [s.get('default', f'{s["profiles"]}/system') for s in systems.values()]
+  return targets, defaults
+
+def install_multi(args: argparse.Namespace) -> None:
+  '''
+  Install boot files and menus for many systems at once, e.g. on the netboot server.
+  Bootspecs and boot files are shared between all of the systems.
+  '''
+  targets, defaults = multi_targets(args)
+  if not targets:
+    return
+  blob_dir = targets[0].blob_dir
+
+  cache_file = f'{args.output}/{BOOTSPEC_CACHE}'
+  load_bootspec_cache(cache_file)
+  with ThreadPoolExecutor(max_workers=min(len(targets), MAX_WORKERS)) as executor:
+    results = list(executor.map(install_bootloader, targets, defaults))
+  save_bootspec_cache(cache_file)
+
+  # Blobs are shared, so only those not used by any system can go
+  remove_old_blobs(
+    blob_dir,
+    set().union(*(old for old, _, _ in results)),
+    set().union(*(in_use for _, in_use, _ in results)))
+  dedup_report([f for _, _, files in results for f in files])
+
+  write_chooser_menu(args.output, targets)
+
+def stat_key(st: os.stat_result) -> str:
+  return f'{st.st_dev}:{st.st_ino}:{st.st_size}:{st.st_mtime_ns}'
+
+def verify(t: Target) -> bool:
+  '''
+  Check the installed boot files still match the store, reinstalling any that don't.
+  Files are only re-hashed if their inode metadata changed since they were last checked.
+  '''
+  manifest = load_manifest(t)
+  if manifest is None:
+    print(f'{t.system_name}: no manifest, nothing to verify', file=sys.stderr)
+    return False
+  files = manifest['files']
+
+  index_file = f'{t.boot_dir}/{VERIFY_INDEX}'
+  try:
+    with open(index_file, 'r') as f:
+      index = json.load(f)
+  except (OSError, ValueError):
+    index = {}
+
+  missing = set()
+  to_hash = {}
+  hashes = {}
+  for p in files:
+    try:
+      st = os.stat(f'{t.boot_dir}{p}')
+    except FileNotFoundError:
+      missing.add(p)
+      continue
+    key = stat_key(st)
+    if key in index:
+      hashes[p] = index[key]
+    else:
+      # Hard links to the same blob only need hashing once
+      to_hash.setdefault(key, []).append(p)
+
+  with trace.span('phase', 'verify-hash', system=t.system_name):
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+      for paths, digest in zip(to_hash.values(), executor.map(lambda ps: hash_file(f'{t.boot_dir}{ps[0]}'), to_hash.values())):
+        for p in paths:
+          hashes[p] = digest
+
+  corrupt = {p for p, digest in hashes.items() if digest != files[p]['hash']}
+  for p in sorted(missing | corrupt):
+    print(f'{t.system_name}: {p} is {"missing" if p in missing else "corrupt"}, reinstalling', file=sys.stderr)
+
+  # Corruption of one name means the (shared) blob is corrupt too
+  with trace.span('phase', 'verify-repair', system=t.system_name):
+    remove_old_files(t.blob_dir, {f'/{files[p]["hash"]}' for p in corrupt})
+    for digest in {files[p]['hash'] for p in missing | corrupt}:
+      names = [p for p, f in files.items() if f['hash'] == digest]
+      install_blob(t, files[names[0]], f'{t.boot_dir}{names[0]}')
+      for p in names:
+        link_blob(t, digest, f'{t.boot_dir}{p}')
+
+  # Everything now matches the manifest
+  new_index = {}
+  for p, f in files.items():
+    new_index[stat_key(os.stat(f'{t.boot_dir}{p}'))] = f['hash']
+  write_json(index_file, new_index)
+
+  print(f'{t.system_name}: verified {len(files)} files ({sum(len(ps) for ps in to_hash.values())} re-hashed), '
+        f'{len(missing | corrupt)} reinstalled', file=sys.stderr)
+  return not (missing or corrupt)
 
 def main() -> None:
   parser = argparse.ArgumentParser(description=f'Update {DISTRO_NAME}-related netboot files')
-  parser.add_argument('default_config', metavar='DEFAULT-CONFIG', help=f'The default {DISTRO_NAME} config to boot')
+  parser.add_argument('default_config', metavar='DEFAULT-CONFIG', nargs='?', help=f'The default {DISTRO_NAME} config to boot')
+  parser.add_argument('--systems', metavar='MANIFEST',
+    help='JSON file mapping system names to their profiles directory (and optionally distro, default config and ' +
+         'configuration limit), to install boot files for all of them at once')
+  parser.add_argument('-o', '--output', default='/srv/netboot/systems', help='Directory to install systems into (with --systems)')
+  parser.add_argument('--verify', action='store_true',
+    help='Check installed boot files against the store (re-hashing only changed files) and reinstall any that differ')
+  parser.add_argument('--timings', action='store_true', help='Print a summary of where time was spent')
+  parser.add_argument('--trace-json', metavar='FILE', help='Write all recorded events to FILE as JSON')
+  parser.add_argument('--chrome-trace', metavar='FILE', help='Write all recorded events to FILE in Chrome trace event format')
   args = parser.parse_args()
-
-  subprocess.check_call(CHECK_MOUNTPOINTS)
-
-  install_bootloader(args)
+  if not args.systems and not args.default_config and not args.verify:
+    parser.error('either DEFAULT-CONFIG or --systems is required')
+
+  trace.enabled = args.timings or args.trace_json or args.chrome_trace
+  try:
+    if args.verify:
+      targets = multi_targets(args)[0] if args.systems else [Target()]
+      if not all([verify(t) for t in targets]):
+        sys.exit(1)
+    elif args.systems:
+      install_multi(args)
+    else:
+      install_single(args)
+  finally:
+    # Also useful (maybe especially so) when something failed
+    if args.trace_json:
+      trace.write_json(args.trace_json)
+    if args.chrome_trace:
+      trace.write_chrome_trace(args.chrome_trace)
+    if args.timings:
+      trace.print_summary()
 
 if __name__ == '__main__':
   main()
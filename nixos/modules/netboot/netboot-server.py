@@ -0,0 +1,310 @@
+#! @python3@/bin/python3 -B
+# Minimal HTTP server for netboot files (kernels / initrds / menus), with a load test client
+import argparse
+import asyncio
+import email.utils
+import json
+import os
+import posixpath
+import stat
+import sys
+import time
+import urllib.parse
+from collections import defaultdict
+from typing import Dict, NamedTuple
+
+# Written by netboot-loader-builder into each system's directory
+MANIFEST = 'manifest.json'
+BLOB_DIR = '.blobs'
+STATS_PATH = '/.stats'
+MAX_HEADER_SIZE = 16 * 1024
+READ_CHUNK = 1024 * 1024
+
+STATUS = {
+  200: 'OK',
+  206: 'Partial Content',
+  304: 'Not Modified',
+  400: 'Bad Request',
+  404: 'Not Found',
+  405: 'Method Not Allowed',
+  416: 'Range Not Satisfiable',
+}
+
+class Request(NamedTuple):
+  method: str
+  path: str
+  version: str
+  headers: Dict[str, str]
+
+class FileStats:
+  def __init__(self):
+    self.requests = 0
+    self.bytes_sent = 0
+
+def parse_range(header: str, size: int) -> tuple[int, int] | None:
+  '''
+  Parse a single-range `Range` header into an inclusive (start, end) pair.
+  Returns None if the header should be ignored; raises ValueError if it can't be satisfied.
+  '''
+  unit, _, spec = header.partition('=')
+  if unit.strip() != 'bytes' or ',' in spec:
+    # Multiple ranges are allowed to be answered with the whole file
+    return None
+  start, sep, end = spec.strip().partition('-')
+  if not sep:
+    return None
+  if not start:
+    # Suffix range (last N bytes)
+    if not end:
+      return None
+    n = int(end)
+    if n == 0:
+      raise ValueError('empty suffix range')
+    return max(0, size - n), size - 1
+
+  start = int(start)
+  end = int(end) if end else size - 1
+  if start >= size or end < start:
+    raise ValueError('unsatisfiable range')
+  return start, min(end, size - 1)
+
+class NetbootServer:
+  def __init__(self, root: str):
+    self.root = os.path.abspath(root)
+    self.stats: Dict[str, FileStats] = defaultdict(FileStats)
+    self.manifests: Dict[str, tuple[int, Dict[str, str]]] = {}
+
+  def resolve(self, path: str) -> str | None:
+    path = posixpath.normpath(urllib.parse.unquote(path))
+    if not path.startswith('/') or '..' in path.split('/'):
+      return None
+    return self.root + path
+
+  def manifest_hashes(self, system_dir: str) -> Dict[str, str]:
+    # Reloaded only when the builder has rewritten the manifest
+    manifest_file = os.path.join(system_dir, MANIFEST)
+    try:
+      mtime = os.stat(manifest_file).st_mtime_ns
+    except OSError:
+      return {}
+    cached = self.manifests.get(system_dir)
+    if cached and cached[0] == mtime:
+      return cached[1]
+
+    try:
+      with open(manifest_file, 'r') as f:
+        files = json.load(f).get('files', {})
+      hashes = {p: f['hash'] for p, f in files.items()}
+    except (OSError, ValueError, KeyError):
+      hashes = {}
+    self.manifests[system_dir] = (mtime, hashes)
+    return hashes
+
+  def etag(self, file: str, st: os.stat_result) -> str:
+    # Boot files are named after (or listed with) their content hash; fall back to a weak validator
+    parent, name = os.path.split(file)
+    if os.path.basename(parent) == BLOB_DIR:
+      return f'"{name}"'
+    system_dir = os.path.dirname(parent)
+    digest = self.manifest_hashes(system_dir).get('/' + os.path.relpath(file, system_dir))
+    if digest:
+      return f'"{digest}"'
+    return f'W/"{st.st_size:x}-{st.st_mtime_ns:x}"'
+
+  async def read_request(self, reader: asyncio.StreamReader) -> Request | None:
+    try:
+      head = await reader.readuntil(b'\r\n\r\n')
+    except asyncio.IncompleteReadError:
+      return None
+    except asyncio.LimitOverrunError:
+      raise ValueError('request headers too large')
+
+    lines = head.decode('latin-1').split('\r\n')
+    method, target, version = lines[0].split(' ', 2)
+    headers = {}
+    for line in lines[1:]:
+      if not line:
+        continue
+      k, _, v = line.partition(':')
+      headers[k.strip().lower()] = v.strip()
+    return Request(method, target.split('?', 1)[0], version, headers)
+
+  def send_head(self, writer: asyncio.StreamWriter, status: int, headers: Dict[str, str | int]) -> None:
+    lines = [f'HTTP/1.1 {status} {STATUS[status]}', f'Date: {email.utils.formatdate(usegmt=True)}']
+    lines += [f'{k}: {v}' for k, v in headers.items()]
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+
+  def send_simple(self, writer: asyncio.StreamWriter, status: int, body: bytes = b'',
+                  content_type: str = 'text/plain', head_only: bool = False, **headers) -> None:
+    self.send_head(writer, status, {'Content-Type': content_type, 'Content-Length': len(body), **headers})
+    if not head_only:
+      writer.write(body)
+
+  async def serve_file(self, req: Request, writer: asyncio.StreamWriter) -> None:
+    file = self.resolve(req.path)
+    if file is None:
+      self.send_simple(writer, 400, b'Bad path\n')
+      return
+    try:
+      f = open(file, 'rb')
+    except (FileNotFoundError, NotADirectoryError, IsADirectoryError, PermissionError):
+      self.send_simple(writer, 404, b'Not found\n', head_only=req.method == 'HEAD')
+      return
+
+    with f:
+      st = os.fstat(f.fileno())
+      if not stat.S_ISREG(st.st_mode):
+        self.send_simple(writer, 404, b'Not found\n', head_only=req.method == 'HEAD')
+        return
+
+      etag = self.etag(file, st)
+      headers = {
+        'Content-Type': 'application/octet-stream',
+        'Accept-Ranges': 'bytes',
+        'ETag': etag,
+        'Last-Modified': email.utils.formatdate(st.st_mtime, usegmt=True),
+      }
+      inm = req.headers.get('if-none-match')
+      if inm and (inm.strip() == '*' or etag in (t.strip() for t in inm.split(','))):
+        self.send_head(writer, 304, headers)
+        return
+
+      status = 200
+      start, end = 0, st.st_size - 1
+      if 'range' in req.headers and (req.headers.get('if-range', etag) == etag):
+        try:
+          r = parse_range(req.headers['range'], st.st_size)
+        except ValueError:
+          self.send_simple(writer, 416, **{'Content-Range': f'bytes */{st.st_size}'})
+          return
+        if r:
+          status = 206
+          start, end = r
+          headers['Content-Range'] = f'bytes {start}-{end}/{st.st_size}'
+
+      count = end - start + 1
+      headers['Content-Length'] = count
+      self.send_head(writer, status, headers)
+      if req.method == 'HEAD' or count == 0:
+        return
+
+      await writer.drain()
+      stats = self.stats[req.path]
+      stats.requests += 1
+      # Uses sendfile(2) for plain TCP transports
+      sent = await asyncio.get_running_loop().sendfile(writer.transport, f, start, count)
+      stats.bytes_sent += sent
+
+  async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+      while True:
+        try:
+          req = await self.read_request(reader)
+        except ValueError:
+          self.send_simple(writer, 400, b'Bad request\n')
+          break
+        if req is None:
+          break
+
+        if req.method not in ('GET', 'HEAD'):
+          self.send_simple(writer, 405, b'Method not allowed\n', Allow='GET, HEAD')
+        elif req.path == STATS_PATH:
+          body = json.dumps({p: vars(s) for p, s in self.stats.items()}).encode('utf-8')
+          self.send_simple(writer, 200, body, 'application/json', req.method == 'HEAD')
+        else:
+          await self.serve_file(req, writer)
+        await writer.drain()
+
+        if req.version != 'HTTP/1.1' or req.headers.get('connection', '').lower() == 'close':
+          break
+    except (ConnectionError, asyncio.IncompleteReadError):
+      pass
+    finally:
+      writer.close()
+
+async def serve(args: argparse.Namespace) -> None:
+  server = NetbootServer(args.root)
+  srv = await asyncio.start_server(server.handle, args.listen, args.port, limit=MAX_HEADER_SIZE, backlog=1024)
+  print(f'Serving {server.root} on {", ".join(str(s.getsockname()) for s in srv.sockets)}', file=sys.stderr)
+  async with srv:
+    await srv.serve_forever()
+
+async def http_get(url: str, keep: bool = False) -> tuple[int, bytes]:
+  '''Fetch `url`, returning the length of the body (and the body itself if `keep`).'''
+  u = urllib.parse.urlsplit(url)
+  reader, writer = await asyncio.open_connection(u.hostname, u.port or 80, limit=MAX_HEADER_SIZE)
+  try:
+    writer.write(f'GET {u.path or "/"} HTTP/1.1\r\nHost: {u.netloc}\r\nConnection: close\r\n\r\n'.encode('latin-1'))
+    head = (await reader.readuntil(b'\r\n\r\n')).decode('latin-1')
+    status = int(head.split(' ', 2)[1])
+    if status != 200:
+      raise RuntimeError(f'GET {url}: HTTP {status}')
+
+    n = 0
+    body = bytearray()
+    while chunk := await reader.read(READ_CHUNK):
+      n += len(chunk)
+      if keep:
+        body += chunk
+    return n, bytes(body)
+  finally:
+    writer.close()
+
+def boot_files(menu: str, server: str) -> list[str]:
+  # Kernel and initrd of the default entry of a menu.ipxe written by the builder
+  default = menu.split('--default ', 1)[1].split()[0]
+  entry = menu.split(f'\n:{default}\n', 1)[1]
+  urls = []
+  for line in entry.split('\n'):
+    cmd, _, rest = line.partition(' ')
+    if cmd in ('kernel', 'initrd'):
+      urls.append(rest.split()[0].replace('${server}', server))
+    elif cmd == 'boot':
+      break
+  return urls
+
+async def simulate_boot(urls: list[str]) -> int:
+  total = 0
+  for url in urls:
+    n, _ = await http_get(url)
+    total += n
+  return total
+
+async def loadtest(args: argparse.Namespace) -> None:
+  server = args.url.rstrip('/')
+  _, menu = await http_get(f'{server}/systems/{args.system}/menu.ipxe', keep=True)
+  urls = boot_files(menu.decode('utf-8'), server)
+
+  start = time.monotonic()
+  totals = await asyncio.gather(*(simulate_boot(urls) for _ in range(args.clients)))
+  elapsed = time.monotonic() - start
+
+  total = sum(totals)
+  print(f'{args.clients} boots of {args.system} ({len(urls)} files each): '
+        f'{total/1024/1024:.1f}MiB in {elapsed:.2f}s, {total/1024/1024/elapsed:.1f}MiB/s aggregate, '
+        f'{elapsed/args.clients*1000:.1f}ms per boot')
+
+def main() -> None:
+  parser = argparse.ArgumentParser(description='Serve netboot files over HTTP')
+  subparsers = parser.add_subparsers(dest='command', required=True)
+
+  p = subparsers.add_parser('serve', help='serve files from the netboot root')
+  p.add_argument('-r', '--root', default='/srv/netboot', help='directory to serve')
+  p.add_argument('-l', '--listen', default=None, help='address to listen on (default all)')
+  p.add_argument('-p', '--port', type=int, default=80, help='port to listen on')
+  p.set_defaults(func=serve)
+
+  p = subparsers.add_parser('loadtest', help='simulate many clients booting at once')
+  p.add_argument('url', metavar='URL', help='base URL of the netboot server')
+  p.add_argument('system', metavar='SYSTEM', help='system whose default entry should be booted')
+  p.add_argument('-n', '--clients', type=int, default=16, help='number of simultaneous boots')
+  p.set_defaults(func=loadtest)
+
+  args = parser.parse_args()
+  try:
+    asyncio.run(args.func(args))
+  except KeyboardInterrupt:
+    pass
+
+if __name__ == '__main__':
+  main()